@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+'''
+
+KRIS ASM assembler routines for KRIS VM
+Author : Benjamin Evrard - @tsunulukai 🦆 - https://adelpha.be/
+
+Sources are assembled in two passes: the first one matches each line with a
+single regular expression and gives an address to every label, the second
+one evaluates the operands and emits the bytes:
+
+    count   equ     0d              # Constant
+    loop:   SET_R1  count - 1       # Labels may stand alone on their line
+            JNZ     loop
+    str:    db      "Hello", 0      # Data bytes and strings
+            org     0xa0            # Origin, same as address_a0h:
+            0x48 0x65 0x6c          # Raw bytes
+
+Numbers are hexadecimal, with or without 0x. Names which aren't symbols
+but are valid hexadecimal (ff, e0) are read as numbers too.
+Expressions combine numbers, 'c' characters, symbols and $ (address of the
+current line) with + - * / % & | ^ ~ << >> and parentheses.
+
+'''
+
+__description__ = 'KRIS ASM assembler routines'
+__author__      = 'Benjamin Evrard'
+
+import ast
+import re
+
+from kris_cpu import OC
+
+
+HELP_CMDS = ["h", "m", "help", "man", "?"]
+
+ALIASES = {"SET_REG1": "SET_R1", "HALT": "HLT"}
+OPCODES = dict(OC, **{alias: OC[k] for alias, k in ALIASES.items()})
+
+NAME   = r"[A-Za-z_.][\w.]*"
+STRING = r'''"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*\''''
+ARGS   = r'''(?:%s|[^#;"'])*''' % STRING
+
+LINE_RE = re.compile(r'''
+    \s*(?:address_(?P<org>\w*)h:|(?P<label>%s):)?           # Origin directive or label
+    \s*(?:(?P<name>%s)\s+(?i:equ)\s+(?P<value>%s)           # Constant
+         |(?P<op>%s)(?:\s+(?P<args>%s))?                    # Instruction, db or org
+         |(?P<bytes>(?:0x[0-9a-fA-F]{1,2}\s*)+)             # Raw bytes
+    )?\s*(?P<comment>[#;].*)?$''' % (NAME, NAME, ARGS, NAME, ARGS), re.X)
+
+TOKEN_RE = re.compile(r'''\s*(?:
+    (?P<num>0x[0-9a-fA-F]+|[0-9][0-9a-fA-F]*)
+    |(?P<chr>'(?:[^'\\]|\\.)*')
+    |(?P<name>%s|\$)
+    |(?P<op><<|>>|[-+*/%%&|^~()]))''' % NAME, re.X)
+
+ITEM_RE = re.compile(r'''%s|[^,"']+|,''' % STRING)
+
+HEX_RE  = re.compile(r"(0x)?[0-9a-fA-F]+")
+
+
+def literal(token):                     # Returns the bytes of a "string" or 'c' literal
+    try:
+        return ast.literal_eval(token).encode("latin-1")
+    except (SyntaxError, ValueError, UnicodeEncodeError):
+        raise ValueError("Invalid literal %s" % token)
+
+
+def evaluate(expr, symbols, p=0, strict=False):     # Returns the value of an expression, raises ValueError
+    src = []
+    expr = expr.strip()
+    pos = 0
+    while pos < len(expr):
+        m = TOKEN_RE.match(expr, pos)
+        if not m:
+            raise ValueError("Invalid expression '%s'" % expr)
+        pos = m.end()
+        if m["num"]:
+            src.append(str(int(m["num"], 16)))
+        elif m["chr"]:
+            val = literal(m["chr"])
+            if len(val) != 1:
+                raise ValueError("Invalid character %s" % m["chr"])
+            src.append(str(val[0]))
+        elif m["name"] == "$":
+            src.append(str(p))
+        elif m["name"]:
+            val = symbols.get(m["name"])        # None for symbols whose value isn't known yet
+            if val is None and m["name"] not in symbols and not strict and HEX_RE.fullmatch(m["name"]):
+                val = int(m["name"], 16)        # Bare hex number starting with a letter
+            if val is None:
+                raise ValueError("Undefined symbol '%s'" % m["name"])
+            src.append(str(val))
+        else:
+            src.append("//" if m["op"] == "/" else m["op"])
+    try:
+        return int(eval(" ".join(src) or "None", {"__builtins__": {}}))
+    except (SyntaxError, TypeError, ZeroDivisionError):
+        raise ValueError("Invalid expression '%s'" % expr)
+
+
+def byte(val):                          # Returns val as a byte, negative values being two's complement
+    if not -0x80 <= val <= 0xff:
+        raise ValueError("Value '0x%02x' out of range" % val)
+    return val & 0xff
+
+
+def split_args(args):                   # Returns the comma separated operands of a db directive
+    items = [""]
+    for m in ITEM_RE.finditer(args or ""):
+        if m.group() == ",":
+            items.append("")
+        else:
+            items[-1] += m.group()
+    return [item.strip() for item in items]
+
+
+def size(op, args):                     # Returns the size in bytes of an instruction or db directive
+    if op == "DB":
+        return sum(len(literal(item)) if item[:1] == '"' else 1 for item in split_args(args))
+    return 2 if OPCODES[op] >> 4 == 2 else 1
+
+
+def encode(op, args, symbols, p):       # Returns the bytes of an instruction or db directive at address p
+    if op == "DB":
+        retv = []
+        for item in split_args(args):
+            if not item:
+                raise ValueError("Missing db operand")
+            retv += literal(item) if item[:1] == '"' else [byte(evaluate(item, symbols, p))]
+        return retv
+    opcode = OPCODES[op]
+    if opcode >> 4 == 2:
+        if not args:
+            raise ValueError("Missing argument for '%s' instruction" % op)
+        return [opcode, byte(evaluate(args, symbols, p))]
+    if args:
+        raise ValueError("'%s' instruction takes no argument" % op)
+    return [opcode]
+
+
+def origin(val):                        # Returns val as an address
+    if val != val & 0xff:
+        raise ValueError("Address '0x%02x' out of range" % val)
+    return val
+
+
+def statement(m):                       # Returns the (op, args) of a matched line, op being upper case or None
+    if m["bytes"]:
+        return "DB", ", ".join(m["bytes"].split())
+    if m["op"]:
+        op = m["op"].upper()
+        op = ALIASES.get(op, op)
+        if op not in OPCODES and op not in ["DB", "ORG"]:
+            raise KeyError(m["op"])
+        return op, (m["args"] or "").strip() or None
+    return None, None
+
+
+def asm_line(cmd, p, symbols=None):     # Assembles a single line of KRIS ASM at address p
+    '''
+    Returns a (kind, p, data, text) tuple where:
+      kind  is one of "code", "data", "addr", "symbol", "comment", "empty", "error", "unknown"
+      p     is the address of the next byte to assemble
+      data  is a list of (address, value) tuples to write into memory
+      text  is a human readable description of what was (not) assembled
+    Labels and constants are added to symbols, which operands can refer to.
+    '''
+    symbols = {} if symbols is None else symbols
+    if not cmd.strip():
+        return "empty", p, [], ""
+    if cmd.strip().lower() in HELP_CMDS + ["q"]:
+        return "unknown", p, [], "'%s' Invalid Instruction" % cmd.strip()
+    m = LINE_RE.match(cmd)
+    if not m:
+        return "error", p, [], "Syntax error in '%s'" % cmd.strip()
+    try:
+        op, args = statement(m)
+    except KeyError:
+        return "unknown", p, [], "'%s' Invalid Instruction" % cmd.strip()
+    try:
+        if m["org"] is not None:
+            try:
+                p = origin(int(m["org"], 16))
+            except ValueError:
+                raise ValueError("Invalid Address '%s'" % m["org"])
+        if m["label"]:
+            symbols[m["label"]] = p
+        if m["name"]:
+            symbols[m["name"]] = evaluate(m["value"], symbols, p)
+            return "symbol", p, [], "%s = 0x%02x" % (m["name"], symbols[m["name"]])
+        if op == "ORG":
+            p = origin(evaluate(args or "", symbols, p))
+        if op is None or op == "ORG":
+            if m["org"] is not None or op == "ORG":
+                return "addr", p, [], "Address 0x%02x" % p
+            if m["label"]:
+                return "symbol", p, [], "%s = 0x%02x" % (m["label"], p)
+            return "comment", p, [], cmd.strip()
+        data = encode(op, args, symbols, p)
+    except ValueError as e:
+        return "error", p, [], str(e)
+    if p + len(data) > 0x100:
+        return "error", p, [], "Not enough memory space available for %d bytes" % len(data)
+    if op == "DB":
+        text = "\n".join("*0x%02x: 'DB[0x%02x]'     => '0x%02x'" % (p+i, val, val) for i, val in enumerate(data))
+        return "data", p + len(data), list(enumerate(data, p)), text
+    text = "*0x%02x: %-15s=> '0x%s'" % (p, "'%s%s'" % (op, " " + args if args else ""), bytes(data).hex())
+    return "code", p + len(data), list(enumerate(data, p)), text
+
+
+class Assembly:                         # A KRIS ASM source assembled in two passes
+    '''
+    Holds the assembled 256 bytes image, the address following the last
+    assembled byte (end), the (line number, message) errors, the symbols
+    (name: value), the labels (address: name), the source text of the
+    instruction operands (address: (text, value)) and one (line number,
+    address, bytes, source line) row per source line.
+    '''
+    def __init__(self, src, p=0):
+        self.image = bytearray(0x100)
+        self.end = p
+        self.errors = []
+        self.symbols = {}
+        self.labels = {}
+        self.consts = set()
+        self.refs = {}
+        self.rows = []
+        lines = []
+        pending = []                    # Constants referring to symbols defined further
+        for n, line in enumerate(src.split("\n"), 1):      # Pass 1: addresses and symbols
+            m = LINE_RE.match(line)
+            if line.strip().lower() in HELP_CMDS + ["q"]:
+                m = LINE_RE.match("")
+            try:
+                if not m:
+                    raise ValueError("Syntax error")
+                try:
+                    op, args = statement(m)
+                except KeyError:
+                    raise ValueError("'%s' Invalid Instruction" % m["op"])
+                if m["org"] is not None:
+                    try:
+                        p = origin(int(m["org"], 16))
+                    except ValueError:
+                        raise ValueError("Invalid Address '%s'" % m["org"])
+                if m["label"]:
+                    self.define(m["label"], p)
+                    self.labels.setdefault(p, m["label"])
+                if m["name"]:
+                    self.define(m["name"], None)
+                    self.consts.add(m["name"])
+                    try:                # Known right away unless it refers to symbols defined further
+                        self.symbols[m["name"]] = evaluate(m["value"], self.symbols, p, strict=True)
+                    except ValueError:
+                        pending.append((n, m["name"], m["value"], p))
+                if op == "ORG":
+                    p = origin(evaluate(args or "", self.symbols, p))
+                elif op:
+                    n_bytes = size(op, args)
+                    if p + n_bytes > 0x100:
+                        raise ValueError("Not enough memory space available for %d bytes" % n_bytes)
+                    lines.append((n, line, op, args, p))
+                    p += n_bytes
+                    self.end = p
+                    continue
+            except ValueError as e:
+                self.errors.append((n, str(e)))
+            lines.append((n, line, None, None, p))
+        self.resolve(pending)
+        for n, line, op, args, p in lines:                  # Pass 2: bytes
+            data = []
+            if op:
+                try:
+                    data = encode(op, args, self.symbols, p)
+                except ValueError as e:
+                    self.errors.append((n, str(e)))
+                self.image[p:p+len(data)] = bytes(data)
+                if len(data) == 2 and op != "DB" and not (HEX_RE.fullmatch(args) and args not in self.symbols):
+                    self.refs[p+1] = (args, data[1])
+            self.rows.append((n, p, bytes(data), line.rstrip()))
+        self.errors.sort()
+
+    def define(self, name, val):
+        if name in self.symbols:
+            raise ValueError("Symbol '%s' already defined" % name)
+        self.symbols[name] = val
+
+    def resolve(self, pending):         # Evaluates the constants, in as many rounds as their dependencies need
+        while pending:
+            left = []
+            for n, name, expr, p in pending:
+                try:
+                    self.symbols[name] = evaluate(expr, self.symbols, p)
+                except ValueError as e:
+                    left.append((n, name, expr, p, e))
+            if len(left) == len(pending):
+                for n, name, expr, p, e in left:
+                    self.errors.append((n, str(e)))
+                    del self.symbols[name]
+                return
+            pending = [entry[:4] for entry in left]
+
+    def listing(self):                  # Returns the listing: line number, address, bytes and source of each line
+        retv = ""
+        for n, p, data, line in self.rows:
+            retv += ("%5d  %s  %-11s  %s" % (n, "%02x" % p if data else "  ", data[:4].hex(" "), line)).rstrip() + "\n"
+            for i in range(4, len(data), 4):
+                retv += "%5s  %02x  %s\n" % ("", p+i, data[i:i+4].hex(" "))
+        return retv
+
+    def symbol_table(self):             # Returns the symbols sorted by value, one per line
+        retv = ""
+        for name, val in sorted(self.symbols.items(), key=lambda item: (item[1], item[0])):
+            retv += "%-20s 0x%02x  %s\n" % (name, val, "equ" if name in self.consts else "label")
+        return retv
+
+
+def assemble_source(src, p=0):          # Assembles a complete KRIS ASM source code without any UI
+    '''
+    Returns a (image, end, errors) tuple where:
+      image   is a 256 bytes bytearray holding the assembled program
+      end     is the address following the last assembled byte
+      errors  is a list of (line number, message) tuples
+    '''
+    prog = Assembly(src, p)
+    return prog.image, prog.end, prog.errors
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+'''
+
+Batch runner for KRIS VM
+Author : Benjamin Evrard - @tsunulukai 🦆 - https://adelpha.be/
+
+Runs a set of KRIS programs headless over a pool of worker processes and
+yields one result per program, as soon as it's available:
+
+    import kris_batch
+    for res in kris_batch.batch(["tests/"], jobs=4, max_steps=100000):
+        print(res["program"], res["reason"], res["display"])
+
+Each program gets its own KrisVM, a step budget and a wall time limit,
+which also covers its load and analysis.
+With loops=True, programs whose machine state repeats are stopped early
+with the "cycle" reason and the "period" of their loop. With jit=True,
+programs which kris_flow proves free of self-modifying code run translated
+blocks whose STOREs write memory directly.
+
+'''
+
+__description__ = 'KRIS VM batch runner'
+__author__      = 'Benjamin Evrard'
+
+from kris_cpu import *
+from kris_jit import *
+import kris_flow
+import glob
+import multiprocessing
+import time
+
+
+MAX_STEPS = 1000000                     # Default step budget of a program
+TIMEOUT   = 10                          # Default wall time limit of a program, in seconds
+CHUNK     = 0x10000                     # Instructions executed between two timeout checks
+
+STOP_TIMEOUT = "timeout"                # Wall time limit exceeded
+STOP_ERROR   = "error"                  # Program couldn't be loaded
+
+
+def find_programs(paths):               # Returns the .kris/.krisa files of directories and glob patterns
+    retv = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = glob.glob(os.path.join(path, "*.kris")) + glob.glob(os.path.join(path, "*.krisa"))
+        else:
+            files = glob.glob(path, recursive=True)
+        retv += sorted(f for f in files if os.path.isfile(f))
+    return retv
+
+
+def run_job(job):                       # Runs a single (program, max_steps, timeout, jit, loops) job, returns its result
+    prog, max_steps, timeout, jit, loops = job
+    t0 = time.perf_counter()
+    res = {"program": prog}
+    vm = KrisVM(engine=jit_run if jit else cpu_run, loops=LoopDetector() if loops else None)
+    try:
+        vm.load(prog)
+    except (OSError, ValueError, UnicodeDecodeError) as e:
+        res.update({"reason": STOP_ERROR, "error": str(e), "time": round(time.perf_counter() - t0, 6)})
+        return res
+    if jit and not kris_flow.Analysis(vm.image).self_modifying:
+        vm.jit = BlockCache(vm.memory, smc=False)   # Fast path: the code never changes, STOREs write memory directly
+    reason = STOP_MAX_STEPS
+    while vm.cycles < max_steps:
+        if time.perf_counter() - t0 >= timeout:     # Checked first, as the analysis may already have used it all
+            reason = STOP_TIMEOUT
+            break
+        reason = vm.run(min(CHUNK, max_steps - vm.cycles))
+        if reason != STOP_MAX_STEPS:
+            break
+    res.update({
+        "reason"    : reason,
+        "steps"     : vm.cycles,
+        "registers" : {reg: vm.r[reg] for reg in ["PC", "PTR", "R1", "R2"]},
+        "display"   : display_text(vm),
+        "time"      : round(time.perf_counter() - t0, 6),
+    })
+    if reason == STOP_CYCLE:
+        res["period"] = vm.loops.period
+    return res
+
+
+def batch(paths, jobs=None, max_steps=MAX_STEPS, timeout=TIMEOUT, jit=False, loops=False):  # Yields the result of each program, unordered
+    if jobs is not None and jobs < 1:
+        raise ValueError("Invalid number of jobs %d" % jobs)
+    work = [(prog, max_steps, timeout, jit, loops) for prog in find_programs(paths)]
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(work) <= 1:
+        yield from map(run_job, work)
+        return
+    with multiprocessing.Pool(min(jobs, len(work))) as pool:
+        yield from pool.imap_unordered(run_job, work)
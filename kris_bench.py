@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+'''
+
+Benchmark of the KRIS VM execution engines
+
+Usage:
+    kris_bench.py [options] [<program>]
+
+Options:
+    -n <runs>       Number of times the program is run per engine [default: 200]
+    -s <steps>      Stops a run after this many instructions [default: 100000]
+    -a              Program file is in KRIS asm
+    <program>       Program to benchmark (defaults to helloworld.kris)
+
+Each run boots the program and executes it until it halts or exhausts its
+step budget, then the number of executed instructions per second is reported
+for every engine, along with the reason the runs stopped.
+
+'''
+
+__description__ = 'KRIS VM execution engines benchmark'
+__author__      = 'Benjamin Evrard'
+
+from kris_cpu import *
+from kris_jit import *
+import docopt
+import time
+
+
+def baseline_run(content, max_steps):   # Interpreter as it was before the dispatch table
+    def get_asm(opcode):
+        for k in OC:
+            if OC[k] == opcode:
+                return k
+        return "DB[%02x]" % opcode
+
+    memory = bytes(content) + b"\x00" * (0x100 - len(content))
+    r = {"OPC": -1, "PC": 0, "PTR": 0, "R1": 0, "R2": 0}
+    halt = False
+    reason = STOP_MAX_STEPS
+    steps = 0
+    while not halt and steps != max_steps:
+        steps += 1
+        r["OPC"] = r["PC"]
+        opcode = memory[r["PC"]]
+        arg = memory[(r["PC"]+1) & 0xff]
+        instr = get_asm(opcode)
+        if instr == "XOR":
+            r["R1"] ^= r["R2"]
+        if instr == "ADD":
+            r["R1"] += r["R2"]
+            r["R1"] &= 0xff
+        if instr == "LOAD":
+            r["R1"] = memory[r["PTR"]]
+        if instr == "STORE":
+            memory = list(memory)
+            memory[r["PTR"]] = r["R1"]
+            memory = bytes(memory)
+        if instr == "SET_PTR":
+            r["PTR"] = r["R1"]
+        if instr == "SWAP":
+            r["R1"], r["R2"] = r["R2"], r["R1"]
+        if instr == "SET_R1":
+            r["R1"] = arg
+        if instr == "HLT" or "DB[" in instr:
+            halt = True
+            reason = STOP_HALT if instr == "HLT" else STOP_INVALID
+        if instr == "JNZ" and r["R1"] != 0:
+            ni = arg
+            if ni == r["PC"]:
+                halt = True
+                reason = STOP_LOOP
+        elif instr == "HLT":
+            ni = r["PC"]
+        else:
+            ni = (r["PC"] + (opcode >> 4)) & 0xff
+        r["PC"] = ni
+    return steps, reason
+
+
+def dispatch_run(content, max_steps):   # Table driven interpreter of kris_cpu
+    m = boot(content)
+    reason = cpu_run(m, max_steps)
+    return m["cycles"], reason
+
+
+def jit_block_run(content, max_steps):  # Basic block translation cache of kris_jit
+    m = boot(content)
+    reason = jit_run(m, max_steps)
+    return m["cycles"], reason
+
+
+ENGINES = [
+    ("baseline", baseline_run),
+    ("dispatch", dispatch_run),
+    ("jit",      jit_block_run),
+]
+
+
+def bench(content, runs, max_steps=100000, engines=ENGINES):  # Returns a list of (engine, steps, seconds, instructions/s, reason)
+    retv = []
+    for name, fn in engines:
+        steps = 0
+        t0 = time.perf_counter()
+        for i in range(runs):
+            n, reason = fn(content, max_steps)
+            steps += n
+        dt = time.perf_counter() - t0
+        retv.append((name, steps, dt, steps / dt, reason))
+    return retv
+
+
+def main():
+    args = docopt.docopt(__doc__)
+    prog = args["<program>"] or "helloworld.kris"
+    runs = int(args["-n"])
+    max_steps = int(args["-s"])
+    content = load_program(prog, True if args["-a"] else None)
+
+    print("%s, %d runs" % (prog, runs))
+    results = bench(content, runs, max_steps)
+    for name, steps, dt, ips, reason in results:
+        print("  %-10s %10d instr %8.3f s %12.0f instr/s  x%.1f  %s" % (name, steps, dt, ips, ips / results[0][3], reason))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1043 @@
+#!/usr/bin/env python3
+
+'''
+
+Headless execution core for KRIS VM
+Author : Benjamin Evrard - @tsunulukai 🦆 - https://adelpha.be/
+
+The core has no dependency on the debugger UI: it neither draws, sleeps nor
+logs status strings, so it can be used to batch-run KRIS programs:
+
+    import kris_cpu
+    m = kris_cpu.run_program("helloworld.krisa", max_steps=10000)
+    print(kris_cpu.dump_machine(m))
+
+or through the KrisVM class, for longer lived machines.
+
+'''
+
+__description__ = 'KRIS headless execution core'
+__author__      = 'Benjamin Evrard'
+
+from collections import deque, namedtuple
+import array
+import bisect
+import json
+import os
+import re
+import struct
+
+
+# VM Opcodes
+OC = {
+    "HLT"      : 0x0F,  # HALTS THE CPU
+    "XOR"      : 0x10,  # R1 = R1 ^ R2
+    "ADD"      : 0x11,  # R1 = R1 + R2
+    "LOAD"     : 0x12,  # R1 = *PTR
+    "STORE"    : 0x13,  # *PTR = R1
+    "SET_PTR"  : 0x14,  # PTR = R1
+    "SWAP"     : 0x15,  # R1 <-> R2
+    "SET_R1"   : 0x20,  # R1 = arg;
+    "JNZ"      : 0x21   # JMP NOT ZERO to arg
+}
+
+# Reasons for the CPU to stop executing instructions
+STOP_HALT       = "halt"            # HLT instruction
+STOP_LOOP       = "loop"            # JNZ to itself
+STOP_INVALID    = "invalid"         # Invalid instruction
+STOP_BREAKPOINT = "breakpoint"      # Breakpoint hit
+STOP_MAX_STEPS  = "max_steps"       # Step budget exhausted
+STOP_HISTORY    = "history"         # Start of the execution history reached while stepping back
+STOP_WATCH      = "watch"           # Watched memory address read or written
+STOP_CONDITION  = "condition"       # Register condition met
+STOP_CYCLE      = "cycle"           # Machine state repeated: deterministic infinite loop
+
+DISPLAY = 0xf0                      # Memory mapped display (0xf0 - 0xff)
+
+# Save-state layout: header, 256 bytes of RAM, 256 bits of breakpoints
+STATE_MAGIC  = b"KRS1"
+STATE_HDR    = struct.Struct("<4sBhBBBBQ")  # magic, halt, OPC, PC, PTR, R1, R2, cycles
+STATE_SIZE   = STATE_HDR.size + 0x100 + 0x20
+
+
+def get_asm(opcode):
+    return MNEMONIC[opcode]
+
+
+def get_ascii_print(b):
+    if b in range(0x20, 0x7f):
+        return chr(b)
+    else:
+        return "¿"
+
+
+class Memory:                           # 256 bytes of RAM, mutated in place
+    '''
+    Bytes are stored in a bytearray ("data") which is also exposed through a
+    memoryview ("view") so that readers can slice it without copying.
+    Writes go through write(), which tracks the dirty address range and calls
+    the hooks registered on the written address (e.g. the display region).
+    Addresses flagged with HOOK_X hold translated code: writing them calls
+    xhook(lo, hi) so that the translations get invalidated. Bulk writes
+    (load, clear) call the write hooks of every address they cover.
+    '''
+    __slots__ = ("data", "view", "hooked", "rhooks", "whooks", "xhook", "dirty_lo", "dirty_hi", "watches")
+
+    HOOK_R = 1
+    HOOK_W = 2
+    HOOK_X = 4
+    WATCH_R = 8                         # Watchpoints, checked by the LOAD/STORE handlers of DISPATCH_WATCH
+    WATCH_W = 16
+
+    def __init__(self, content=b""):
+        self.data = bytearray(0x100)
+        self.view = memoryview(self.data)
+        self.hooked = bytearray(0x100)      # HOOK_R/HOOK_W flags per address
+        self.rhooks = []                    # (lo, hi, callback) tuples
+        self.whooks = []
+        self.xhook = None
+        self.watches = 0                    # Number of addresses with WATCH_R/WATCH_W flags
+        self.clean()
+        self.load(content)
+
+    def __len__(self):
+        return 0x100
+
+    def __getitem__(self, addr):
+        return self.data[addr]
+
+    def __setitem__(self, addr, val):
+        self.write(addr, val)
+
+    def read(self, addr):
+        if self.hooked[addr] & Memory.HOOK_R:
+            for lo, hi, fn in self.rhooks:
+                if lo <= addr <= hi:
+                    fn(addr, self.data[addr])
+        return self.data[addr]
+
+    def write(self, addr, val):
+        addr &= 0xff
+        self.data[addr] = val
+        if addr < self.dirty_lo:
+            self.dirty_lo = addr
+        if addr > self.dirty_hi:
+            self.dirty_hi = addr
+        hooked = self.hooked[addr]
+        if hooked:
+            if hooked & Memory.HOOK_X:
+                self.xhook(addr, addr)
+            if hooked & Memory.HOOK_W:
+                for lo, hi, fn in self.whooks:
+                    if lo <= addr <= hi:
+                        fn(addr, val)
+
+    def load(self, content, addr=0):    # Copies content into memory starting at addr
+        content = content[:0x100-addr]
+        if content:
+            self.data[addr:addr+len(content)] = content
+            self.dirty_lo = min(self.dirty_lo, addr)
+            self.dirty_hi = max(self.dirty_hi, addr+len(content)-1)
+            if self.xhook:
+                self.xhook(addr, addr+len(content)-1)
+            if self.whooks:
+                self.written(addr, addr+len(content)-1)
+
+    def clear(self):
+        self.data[:] = bytes(0x100)
+        self.dirty_lo = 0
+        self.dirty_hi = 0xff
+        if self.xhook:
+            self.xhook(0, 0xff)
+        if self.whooks:
+            self.written(0, 0xff)
+
+    def written(self, lo, hi):          # Calls the write hooks of the addresses in [lo, hi]
+        for wlo, whi, fn in self.whooks:
+            for addr in range(max(lo, wlo), min(hi, whi)+1):
+                fn(addr, self.data[addr])
+
+    def on_read(self, lo, hi, fn):      # Calls fn(addr, val) whenever an address in [lo, hi] is read
+        self.rhooks.append((lo, hi, fn))
+        for addr in range(lo, hi+1):
+            self.hooked[addr] |= Memory.HOOK_R
+
+    def on_write(self, lo, hi, fn):     # Calls fn(addr, val) whenever an address in [lo, hi] is written
+        self.whooks.append((lo, hi, fn))
+        for addr in range(lo, hi+1):
+            self.hooked[addr] |= Memory.HOOK_W
+
+    def watch(self, lo, hi, flags):     # Sets WATCH_R/WATCH_W flags on [lo, hi]
+        for addr in range(lo, hi+1):
+            if not self.hooked[addr] & (Memory.WATCH_R | Memory.WATCH_W):
+                self.watches += 1
+            self.hooked[addr] |= flags
+
+    def unwatch(self, lo=0, hi=0xff, flags=WATCH_R | WATCH_W):
+        for addr in range(lo, hi+1):
+            if self.hooked[addr] & (Memory.WATCH_R | Memory.WATCH_W):
+                self.hooked[addr] &= ~flags
+                if not self.hooked[addr] & (Memory.WATCH_R | Memory.WATCH_W):
+                    self.watches -= 1
+
+    def dirty(self):                    # Returns the (lo, hi) range written since the last clean(), or None
+        if self.dirty_hi < 0:
+            return None
+        return self.dirty_lo, self.dirty_hi
+
+    def clean(self):
+        self.dirty_lo = 0x100
+        self.dirty_hi = -1
+
+
+def boot(content=b""):                  # Returns a freshly booted machine with content mapped at address 0
+    m = {
+        "r": {
+            "OPC": -1,
+            "PC" : 0,
+            "PTR": 0,
+            "R1" : 0,
+            "R2" : 0,
+        },
+        "memory" : Memory(content),
+        "cycles" : 0,
+        "halt"   : False,
+        "reason" : None,
+        "trace"  : None,
+        "history": None,
+        "profile": None,
+        "loops"  : None,
+    }
+    return m
+
+
+# Instruction handlers
+# Each handler executes the instruction at pc, sets the next PC and returns
+# a STOP_* reason or None when the CPU can go on.
+
+def op_xor(r, mem, pc):
+    r["R1"] ^= r["R2"]
+    r["PC"] = (pc+1) & 0xff
+
+
+def op_add(r, mem, pc):
+    r["R1"] = (r["R1"] + r["R2"]) & 0xff
+    r["PC"] = (pc+1) & 0xff
+
+
+def op_load(r, mem, pc):
+    r["R1"] = mem.read(r["PTR"])
+    r["PC"] = (pc+1) & 0xff
+
+
+def op_store(r, mem, pc):
+    mem.write(r["PTR"], r["R1"])
+    r["PC"] = (pc+1) & 0xff
+
+
+def op_set_ptr(r, mem, pc):
+    r["PTR"] = r["R1"]
+    r["PC"] = (pc+1) & 0xff
+
+
+def op_swap(r, mem, pc):
+    r["R1"], r["R2"] = r["R2"], r["R1"]
+    r["PC"] = (pc+1) & 0xff
+
+
+def op_set_r1(r, mem, pc):
+    r["R1"] = mem.data[(pc+1) & 0xff]
+    r["PC"] = (pc+2) & 0xff
+
+
+def op_jnz(r, mem, pc):
+    if r["R1"] != 0:
+        ni = mem.data[(pc+1) & 0xff]
+        r["PC"] = ni
+        if ni == pc:
+            return STOP_LOOP
+    else:
+        r["PC"] = (pc+2) & 0xff
+
+
+def op_hlt(r, mem, pc):
+    return STOP_HALT
+
+
+def op_invalid(skip):                   # Returns the handler of an invalid opcode, which skips opcode >> 4 bytes
+    def op(r, mem, pc):
+        r["PC"] = (pc+skip) & 0xff
+        return STOP_INVALID
+    return op
+
+
+def op_load_watch(r, mem, pc):          # LOAD of DISPATCH_WATCH, stops after reading a watched address
+    ptr = r["PTR"]
+    r["R1"] = mem.read(ptr)
+    r["PC"] = (pc+1) & 0xff
+    if mem.hooked[ptr] & Memory.WATCH_R:
+        return STOP_WATCH
+
+
+def op_store_watch(r, mem, pc):         # STORE of DISPATCH_WATCH, stops after writing a watched address
+    ptr = r["PTR"]
+    mem.write(ptr, r["R1"])
+    r["PC"] = (pc+1) & 0xff
+    if mem.hooked[ptr] & Memory.WATCH_W:
+        return STOP_WATCH
+
+
+# Decoding tables, indexed by opcode byte
+MNEMONIC = ["DB[%02x]" % opcode for opcode in range(0x100)]
+SIZE     = [(opcode >> 4) or 1 for opcode in range(0x100)]      # Instruction size in bytes
+DISPATCH = [op_invalid(opcode >> 4) for opcode in range(0x100)]
+VALID    = bytearray(0x100)
+
+for k, fn in [("HLT", op_hlt), ("XOR", op_xor), ("ADD", op_add), ("LOAD", op_load), ("STORE", op_store),
+              ("SET_PTR", op_set_ptr), ("SWAP", op_swap), ("SET_R1", op_set_r1), ("JNZ", op_jnz)]:
+    MNEMONIC[OC[k]] = k
+    DISPATCH[OC[k]] = fn
+    VALID[OC[k]] = 1
+
+DISPATCH_WATCH = list(DISPATCH)         # Used instead of DISPATCH while some memory is watched
+DISPATCH_WATCH[OC["LOAD"]]  = op_load_watch
+DISPATCH_WATCH[OC["STORE"]] = op_store_watch
+
+
+# Trace levels
+TRACE_OFF     = 0                       # No trace records
+TRACE_SUMMARY = 1                       # Records of jumps, stores and stops only
+TRACE_FULL    = 2                       # Records of every executed instruction
+TRACE_LEVELS  = {"off": TRACE_OFF, "summary": TRACE_SUMMARY, "full": TRACE_FULL}
+
+SUMMARY = bytearray(0x100)              # Opcodes recorded at TRACE_SUMMARY
+for opcode in range(0x100):
+    SUMMARY[opcode] = opcode in [OC["STORE"], OC["JNZ"], OC["HLT"]] or not VALID[opcode]
+
+# Memory access of each opcode
+MEM_NONE  = 0
+MEM_READ  = 1
+MEM_WRITE = 2
+MEMOP = bytearray(0x100)
+MEMOP[OC["LOAD"]]   = MEM_READ
+MEMOP[OC["SET_R1"]] = MEM_READ
+MEMOP[OC["STORE"]]  = MEM_WRITE
+
+TraceRecord = namedtuple("TraceRecord", ["seq", "pc", "opcode", "arg", "r1", "r2", "ptr",
+                                         "r1_", "r2_", "ptr_", "pc_", "maddr", "mval", "mop"])
+REC = len(TraceRecord._fields) - 1      # Bytes per record in the ring buffer (seq is kept apart)
+
+
+class Trace:                            # Ring buffer of executed instruction records
+    '''
+    Records are written into preallocated buffers: one byte per field plus the
+    cycle number, so recording an instruction allocates nothing. They are only
+    turned into TraceRecord tuples (get(), records()) and text (fmt_record())
+    when somebody needs to read them.
+    '''
+    __slots__ = ("level", "size", "n", "buf", "seq")
+
+    def __init__(self, level=TRACE_FULL, size=4096):
+        self.level = level
+        self.size = size
+        self.n = 0                      # Number of records written so far
+        self.buf = bytearray(size * REC)
+        self.seq = array.array("Q", bytes(8 * size))
+
+    def __len__(self):
+        return min(self.n, self.size)
+
+    def record(self, seq, pc, opcode, arg, r1, r2, ptr, r):
+        i = self.n % self.size
+        self.seq[i] = seq
+        b = self.buf
+        i *= REC
+        b[i]    = pc
+        b[i+1]  = opcode
+        b[i+2]  = arg
+        b[i+3]  = r1
+        b[i+4]  = r2
+        b[i+5]  = ptr
+        b[i+6]  = r["R1"]
+        b[i+7]  = r["R2"]
+        b[i+8]  = r["PTR"]
+        b[i+9]  = r["PC"]
+        mop = MEMOP[opcode]
+        b[i+12] = mop
+        if mop:
+            if opcode == 0x20:          # SET_R1 reads its immediate argument
+                b[i+10] = (pc+1) & 0xff
+            else:
+                b[i+10] = ptr
+            b[i+11] = r["R1"]
+        else:
+            b[i+10] = b[i+11] = 0
+        self.n += 1
+
+    def get(self, n):                   # Returns record number n, or None if it left the buffer
+        if n < 0 or n >= self.n or n < self.n - self.size:
+            return None
+        i = n % self.size
+        return TraceRecord(self.seq[i], *self.buf[i*REC:(i+1)*REC])
+
+    def records(self, count=None):      # Returns the last count records (all by default), oldest first
+        count = len(self) if count is None else min(count, len(self))
+        return [self.get(n) for n in range(self.n - count, self.n)]
+
+    def clear(self):
+        self.n = 0
+
+
+UNDO = 7                                # Bytes per undo log entry: PC, R1, R2, PTR, address, byte, stored
+
+
+class History:                          # Undo log of executed instructions, with periodic keyframes
+    '''
+    Before an instruction gets executed, record() saves the registers and,
+    for STORE, the memory byte about to be overwritten into a ring buffer,
+    so that undo() can take the machine back one instruction at a time.
+    Every "every" cycles a save-state (keyframe) is also kept; once the undo
+    log is exhausted, KrisVM.step_back() restores the last keyframe before
+    its target and replays the instructions from there, which refills the
+    undo log. When the oldest keyframe is past the target, the machine is
+    left unchanged. Only works with a KrisVM, as keyframes are its
+    save-states.
+    '''
+    __slots__ = ("size", "every", "n", "low", "buf", "keyframes")
+
+    def __init__(self, size=0x10000, every=0x1000, keyframes=64):
+        self.size = size
+        self.every = every
+        self.n = 0                      # Number of entries written so far
+        self.low = 0                    # Oldest entry still available
+        self.buf = bytearray(size * UNDO)
+        self.keyframes = deque(maxlen=keyframes)    # (cycles, save-state) tuples, oldest first
+
+    def __len__(self):
+        return self.n - self.low
+
+    def record(self, m, pc, opcode):    # Saves what the instruction at pc is about to overwrite
+        cycles = m["cycles"]
+        kfs = self.keyframes
+        if not kfs or (not cycles % self.every and kfs[-1][0] < cycles):
+            kfs.append((cycles, m.save_state()))
+        r = m["r"]
+        b = self.buf
+        i = (self.n % self.size) * UNDO
+        b[i]   = pc
+        b[i+1] = r["R1"]
+        b[i+2] = r["R2"]
+        b[i+3] = r["PTR"]
+        if opcode == 0x13:              # STORE
+            b[i+4] = r["PTR"]
+            b[i+5] = m["memory"].data[r["PTR"]]
+            b[i+6] = 1
+        else:
+            b[i+6] = 0
+        self.n += 1
+        if self.n - self.low > self.size:
+            self.low += 1
+
+    def undo(self, m):                  # Takes the machine back one instruction, returns False if the log is empty
+        if self.n == self.low:
+            return False
+        self.n -= 1
+        b = self.buf
+        i = (self.n % self.size) * UNDO
+        r = m["r"]
+        r["PC"], r["R1"], r["R2"], r["PTR"] = b[i], b[i+1], b[i+2], b[i+3]
+        if b[i+6]:
+            m["memory"].write(b[i+4], b[i+5])
+        r["OPC"] = b[((self.n-1) % self.size) * UNDO] if self.n > self.low else -1
+        m["cycles"] -= 1
+        m["halt"] = False
+        m["reason"] = None
+        return True
+
+    def keyframe(self, cycles):         # Returns the last (cycles, save-state) keyframe taken at or before cycles
+        for kf in reversed(self.keyframes):
+            if kf[0] <= cycles:
+                return kf
+        return None
+
+    def truncate(self):                 # Empties the undo log, keeping the keyframes
+        self.n = self.low = 0
+
+    def clear(self):
+        self.truncate()
+        self.keyframes.clear()
+
+
+class Profile:                          # Execution profile of a machine, in fixed 256 entries arrays
+    '''
+    Indexed by address: number of instructions executed at the address, of
+    LOAD/STORE reading/writing it, and of JNZ at the address taking the jump
+    or not. Only machines with a profile go through the recording path.
+    '''
+    __slots__ = ("execs", "reads", "writes", "taken", "not_taken")
+
+    FIELDS = ["execs", "reads", "writes", "taken", "not_taken"]
+
+    def __init__(self):
+        for field in Profile.FIELDS:
+            setattr(self, field, array.array("Q", bytes(8 * 0x100)))
+
+    def record(self, m, pc, opcode):    # Counts the instruction at pc, about to be executed
+        self.execs[pc] += 1
+        if opcode == 0x12:              # LOAD
+            self.reads[m["r"]["PTR"]] += 1
+        elif opcode == 0x13:            # STORE
+            self.writes[m["r"]["PTR"]] += 1
+        elif opcode == 0x21:            # JNZ
+            if m["r"]["R1"]:
+                self.taken[pc] += 1
+            else:
+                self.not_taken[pc] += 1
+
+    def clear(self):
+        self.__init__()
+
+    def rows(self):                     # Returns a dict per address with non-zero counts
+        retv = []
+        for addr in range(0x100):
+            row = {field: getattr(self, field)[addr] for field in Profile.FIELDS}
+            if any(row.values()):
+                row["addr"] = addr
+                retv.append(row)
+        return retv
+
+    def csv(self):
+        retv = "addr," + ",".join(Profile.FIELDS) + "\n"
+        for row in self.rows():
+            retv += "0x%02x,%s\n" % (row["addr"], ",".join(str(row[field]) for field in Profile.FIELDS))
+        return retv
+
+    def json(self):
+        return json.dumps([dict({"addr": "0x%02x" % row["addr"]}, **{field: row[field] for field in Profile.FIELDS})
+                           for row in self.rows()], indent=1)
+
+    def save(self, path):               # Exports the profile to a .csv file, or JSON for any other extension
+        with open(path, "w") as f:
+            f.write(self.csv() if path.endswith(".csv") else self.json())
+
+
+class LoopDetector:                     # Brent's cycle detection over the machine states
+    '''
+    The whole state of a KRIS is 256 bytes of RAM and 4 registers, and any
+    infinite execution moves PC backwards (taken JNZ or wrap-around) over and
+    over, so the states after these moves are checked with Brent's algorithm:
+    one state is kept, replaced after 1, 2, 4, 8... checks, and each check
+    compares the current state with it. A match means the machine runs
+    forever, period being the number of instructions of the loop.
+    '''
+    __slots__ = ("state", "at", "power", "checks", "period")
+
+    def __init__(self):
+        self.clear()
+
+    def check(self, r, data, cycles):   # Returns True if the state after cycles instructions was already seen
+        state = bytes((r["PC"], r["PTR"], r["R1"], r["R2"])) + data
+        if state == self.state:
+            self.period = cycles - self.at
+            return True
+        self.checks += 1
+        if self.checks == self.power:
+            self.state, self.at = state, cycles
+            self.power <<= 1
+            self.checks = 0
+        return False
+
+    def clear(self):                    # Forgets the kept state, needed whenever the state changes out of execution
+        self.state = None
+        self.at = 0
+        self.power = 1
+        self.checks = 0
+        self.period = None
+
+
+# Trace record text of each opcode
+TRACE_FMT = {
+    OC["XOR"]     : lambda t: "R1    = 0x%02x (R1) ^ 0x%02x (R2) = 0x%02x" % (t.r1, t.r2, t.r1_),
+    OC["ADD"]     : lambda t: "R1    = 0x%02x (R1) + 0x%02x (R2) = 0x%02x" % (t.r1, t.r2, t.r1_),
+    OC["LOAD"]    : lambda t: "R1    = *0x%02x = 0x%02x" % (t.ptr, t.r1_),
+    OC["STORE"]   : lambda t: "*0x%02x = 0x%02x" % (t.ptr, t.r1),
+    OC["SET_PTR"] : lambda t: "PTR   = 0x%02x" % (t.r1),
+    OC["SWAP"]    : lambda t: "R1    = 0x%02x ; R2 = 0x%02x" % (t.r1_, t.r2_),
+    OC["SET_R1"]  : lambda t: "R1    = 0x%02x (imm)" % (t.arg),
+    OC["JNZ"]     : lambda t: "PC    = 0x%02x (Jump %s)" % (t.pc_, "taken" if t.r1 else "NOT taken"),
+    OC["HLT"]     : lambda t: "System Halted!",
+}
+
+
+def fmt_record(t):                      # Returns the (mnemonic, text) description of a trace record
+    if t.opcode in TRACE_FMT:
+        return MNEMONIC[t.opcode], TRACE_FMT[t.opcode](t)
+    return MNEMONIC[t.opcode], "Invalid instruction!"
+
+
+COND_RE  = re.compile(r"^\s*(PC|PTR|R1|R2)\s*(==|!=|<=|>=|<|>)\s*(0x[0-9a-f]+|[0-9]+)\s*$", re.I)
+COND_SEP = re.compile(r"\s+(and|or)\s+", re.I)
+
+
+def compile_condition(cond):            # Returns the Python source of a condition such as "R1 == 0 or PTR >= 0xf0"
+    parts = COND_SEP.split(cond.strip())
+    retv = []
+    for i, part in enumerate(parts):
+        if i & 1:
+            retv.append(part.lower())
+            continue
+        m = COND_RE.match(part)
+        if not m:
+            raise ValueError("Invalid condition '%s'" % part.strip())
+        retv.append("r[\"%s\"] %s 0x%02x" % (m.group(1).upper(), m.group(2), int(m.group(3), 0) & 0xff))
+    return " ".join(retv)
+
+
+class Breakpoints:                      # Breakpoint addresses: a 256 bytes index plus the sorted list of addresses
+    '''
+    bitmap[addr] is 1 for a breakpoint at addr, 2 when it has a condition on
+    the registers, which is only evaluated when PC reaches addr. Conditions
+    without address ("when") are compiled into the run loop of cpu_run.
+    '''
+    __slots__ = ("bitmap", "addrs", "conds", "when", "when_fn")
+
+    def __init__(self, addrs=()):
+        self.bitmap = bytearray(0x100)
+        self.addrs = []
+        self.conds = {}                 # addr: (condition, predicate)
+        self.when = []                  # Conditions checked after every instruction
+        self.when_fn = None             # Predicate of all the "when" conditions
+        self.update(addrs)
+
+    def __contains__(self, addr):
+        return 0 <= addr < 0x100 and self.bitmap[addr] != 0
+
+    def __iter__(self):
+        return iter(list(self.addrs))
+
+    def __len__(self):
+        return len(self.addrs)
+
+    def add(self, addr, cond=None):     # Returns False if there was already a breakpoint at addr
+        if not 0 <= addr <= 0xff:
+            raise ValueError("Invalid breakpoint address %#x" % addr)
+        if self.bitmap[addr]:
+            return False
+        if cond:
+            self.conds[addr] = (cond, eval("lambda r: " + compile_condition(cond)))
+        self.bitmap[addr] = 2 if cond else 1
+        bisect.insort(self.addrs, addr)
+        return True
+
+    def discard(self, addr):
+        if addr in self:
+            self.bitmap[addr] = 0
+            self.addrs.remove(addr)
+            self.conds.pop(addr, None)
+
+    def add_when(self, cond):           # Breaks wherever cond gets true
+        compile_condition(cond)
+        self.when.append(cond)
+        self.when_fn = eval("lambda r: " + self.when_source())
+
+    def discard_when(self, cond):
+        if cond in self.when:
+            self.when.remove(cond)
+            self.when_fn = eval("lambda r: " + self.when_source()) if self.when else None
+
+    def when_source(self):              # Returns the Python source of the "when" conditions
+        return " or ".join("(%s)" % compile_condition(cond) for cond in self.when)
+
+    def hit_at(self, r):                # Returns the condition of the breakpoint at PC, which must be conditional
+        return self.conds[r["PC"]][1](r)
+
+    def hit(self, r):                   # Returns a STOP_* reason if the registers meet a breakpoint, else None
+        b = self.bitmap[r["PC"]]
+        if b == 1 or (b and self.hit_at(r)):
+            return STOP_BREAKPOINT
+        if self.when_fn and self.when_fn(r):
+            return STOP_CONDITION
+
+    def update(self, addrs):
+        for addr in addrs:
+            self.add(addr)
+
+    def clear(self):
+        self.bitmap[:] = bytes(0x100)
+        self.addrs.clear()
+        self.conds.clear()
+        self.when.clear()
+        self.when_fn = None
+
+    def index(self, addr):              # Returns the position of addr in the sorted list
+        if addr not in self:
+            raise ValueError("No breakpoint at 0x%02x" % addr)
+        return bisect.bisect_left(self.addrs, addr)
+
+
+def bp_bitmap(breakpoints):             # Returns a 256 bytes index of any breakpoint collection
+    if isinstance(breakpoints, Breakpoints):
+        return breakpoints.bitmap
+    retv = bytearray(0x100)
+    for addr in breakpoints:
+        retv[addr] = 1
+    return retv
+
+
+def cpu_exec(m):                        # Executes a single instruction, returns a STOP_* reason or None
+    r = m["r"]
+    mem = m["memory"]
+    pc = r["PC"]
+    opcode = mem.data[pc]
+    if m["history"] is not None:
+        m["history"].record(m, pc, opcode)
+    if m["profile"] is not None:
+        m["profile"].record(m, pc, opcode)
+    r["OPC"] = pc
+    m["cycles"] += 1
+    dispatch = DISPATCH_WATCH if mem.watches else DISPATCH
+    trace = m["trace"]
+    if trace is not None and (trace.level == TRACE_FULL or (trace.level and SUMMARY[opcode])):
+        r1, r2, ptr, arg = r["R1"], r["R2"], r["PTR"], mem.data[(pc+1) & 0xff]
+        reason = dispatch[opcode](r, mem, pc)
+        trace.record(m["cycles"], pc, opcode, arg, r1, r2, ptr, r)
+    else:
+        reason = dispatch[opcode](r, mem, pc)
+    if reason is None and m["loops"] is not None and r["PC"] < pc and m["loops"].check(r, mem.data, m["cycles"]):
+        reason = STOP_CYCLE
+    if reason in [STOP_HALT, STOP_LOOP]:
+        m["halt"] = True
+    return reason
+
+
+# Run loop with the "when" conditions of a Breakpoints inlined, compiled by when_loop()
+WHEN_LOOP = '''
+def loop(r, mem, data, dispatch, bps, hit, max_steps):
+    steps = 0
+    reason = None
+    pc = r["PC"]
+    while steps != max_steps:
+        pc = r["PC"]
+        steps += 1
+        reason = dispatch[data[pc]](r, mem, pc)
+        if reason is not None:
+            break
+        b = bps[r["PC"]]
+        if b and (b == 1 or hit(r)):
+            reason = STOP_BREAKPOINT
+            break
+        if %s:
+            reason = STOP_CONDITION
+            break
+    else:
+        reason = STOP_MAX_STEPS
+    return steps, pc, reason
+'''
+
+when_loops = {}                         # Compiled run loops, indexed by condition source code
+
+
+def when_loop(source):                  # Returns the run loop checking the given condition after each instruction
+    fn = when_loops.get(source)
+    if fn is None:
+        ns = {"STOP_BREAKPOINT": STOP_BREAKPOINT, "STOP_CONDITION": STOP_CONDITION, "STOP_MAX_STEPS": STOP_MAX_STEPS}
+        exec(WHEN_LOOP % source, ns)
+        fn = when_loops[source] = ns["loop"]
+    return fn
+
+
+def cpu_run(m, max_steps=None, breakpoints=()):   # Runs until HALT, breakpoint or step budget exhaustion
+    r = m["r"]
+    mem = m["memory"]
+    data = mem.data
+    dispatch = DISPATCH_WATCH if mem.watches else DISPATCH
+    bps = bp_bitmap(breakpoints)
+    checked = isinstance(breakpoints, Breakpoints)
+    steps = 0
+    reason = None
+    if max_steps is None:
+        max_steps = -1
+    if (m["trace"] is not None and m["trace"].level) or m["history"] is not None or m["profile"] is not None:
+        while steps != max_steps:       # Traced execution, one cpu_exec() per instruction
+            steps += 1
+            reason = cpu_exec(m)
+            if reason is not None:
+                break
+            if checked and (bps[r["PC"]] or breakpoints.when):
+                reason = breakpoints.hit(r)
+                if reason:
+                    break
+            elif bps[r["PC"]]:
+                reason = STOP_BREAKPOINT
+                break
+        else:
+            reason = STOP_MAX_STEPS
+    else:
+        if checked and breakpoints.when:
+            steps, pc, reason = when_loop(breakpoints.when_source())(r, mem, data, dispatch, bps,
+                                                                    breakpoints.hit_at, max_steps)
+        elif m["loops"] is not None:
+            check = m["loops"].check
+            cycles = m["cycles"]
+            while steps != max_steps:   # Same loop, checking the state whenever PC moves backwards
+                pc = r["PC"]
+                steps += 1
+                reason = dispatch[data[pc]](r, mem, pc)
+                if reason is not None:
+                    break
+                b = bps[r["PC"]]
+                if b and (b == 1 or breakpoints.hit_at(r)):
+                    reason = STOP_BREAKPOINT
+                    break
+                if r["PC"] < pc and check(r, data, cycles + steps):
+                    reason = STOP_CYCLE
+                    break
+            else:
+                reason = STOP_MAX_STEPS
+        else:
+            while steps != max_steps:
+                pc = r["PC"]
+                steps += 1
+                reason = dispatch[data[pc]](r, mem, pc)
+                if reason is not None:
+                    break
+                b = bps[r["PC"]]
+                if b and (b == 1 or breakpoints.hit_at(r)):
+                    reason = STOP_BREAKPOINT
+                    break
+            else:
+                reason = STOP_MAX_STEPS
+        if steps:
+            r["OPC"] = pc
+        m["cycles"] += steps
+    if reason in [STOP_HALT, STOP_LOOP]:
+        m["halt"] = True
+    m["reason"] = reason
+    return reason
+
+
+class KrisVM:                           # A KRIS computer: registers, memory, breakpoints and trace
+    '''
+    A KrisVM can be used wherever the core expects a machine (cpu_exec,
+    cpu_run, jit_run, dump_machine, ...) as it also supports m["key"] access
+    to its attributes. Registers are kept in the "r" dict used by the
+    instruction handlers; every other piece of state is held in slots, so
+    that a process can host many small independent machines:
+
+        vm = KrisVM()
+        vm.load("helloworld.krisa")
+        vm.run(10000)
+        print(vm.snapshot())
+    '''
+    __slots__ = ("r", "memory", "cycles", "halt", "reason", "trace", "history", "profile", "loops", "jit", "name",
+                 "image", "breakpoints", "watchpoints", "engine", "post_load", "states")
+
+    def __init__(self, content=b"", trace=None, engine=cpu_run, history=None, profile=None, loops=None):
+        self.r = {}
+        self.memory = Memory()
+        self.trace = trace              # Trace or None
+        self.history = history          # History or None, needed to step back
+        self.profile = profile          # Profile or None
+        self.loops = loops              # LoopDetector or None, stops infinite loops with STOP_CYCLE
+        self.jit = None                 # BlockCache of kris_jit.jit_run
+        self.name = ""
+        self.image = bytes(content)     # Program loaded at address 0 on reset
+        self.breakpoints = Breakpoints()
+        self.watchpoints = []           # (lo, hi, mode) tuples
+        self.engine = engine            # cpu_run, kris_jit.jit_run or any function with the same signature
+        self.post_load = None           # Save-state taken right after the program was loaded, restored on reset
+        self.states = {}                # Named save-states
+        self.reset()
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, val):
+        setattr(self, key, val)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def reset(self, reload=True):       # Clears registers and memory, then reloads the program unless told otherwise
+        if self.history is not None:
+            self.history.clear()
+        if self.loops is not None:
+            self.loops.clear()
+        if reload and self.post_load:
+            self.load_state(self.post_load, breakpoints=False)
+            return
+        self.r.update({
+            "OPC": -1,
+            "PC" : 0,
+            "PTR": 0,
+            "R1" : 0,
+            "R2" : 0,
+        })
+        self.memory.clear()
+        if reload:
+            self.memory.load(self.image)
+        self.cycles = 0
+        self.halt = False
+        self.reason = None
+
+    def load(self, prog, asm=None):     # Loads a program (content or file name) and resets the machine
+        if isinstance(prog, str):
+            self.name = os.path.basename(prog)
+            prog = load_program(prog, asm)
+        self.image = bytes(prog[:0x100])
+        self.post_load = None
+        self.reset()
+        self.post_load = self.save_state()
+
+    def step(self):                     # Executes a single instruction, returns a STOP_* reason or None
+        self.reason = cpu_exec(self)
+        return self.reason
+
+    def run(self, max_steps=None):      # Runs until HALT, breakpoint or step budget exhaustion
+        return self.engine(self, max_steps, self.breakpoints)
+
+    def watch(self, lo, hi=None, mode="w"):     # Stops after a LOAD ("r"), STORE ("w") or both ("rw") of an address in [lo, hi]
+        hi = lo if hi is None else hi
+        flags = (Memory.WATCH_R if "r" in mode else 0) | (Memory.WATCH_W if "w" in mode else 0)
+        if not flags or not 0 <= lo <= hi <= 0xff:
+            raise ValueError("Invalid watchpoint")
+        self.memory.watch(lo, hi, flags)
+        self.watchpoints.append((lo, hi, mode))
+
+    def unwatch(self, watchpoint=None):     # Removes a (lo, hi, mode) watchpoint, or all of them
+        self.watchpoints = [wp for wp in self.watchpoints if watchpoint and wp != watchpoint]
+        self.memory.unwatch()
+        for lo, hi, mode in self.watchpoints:
+            self.memory.watch(lo, hi, (Memory.WATCH_R if "r" in mode else 0) | (Memory.WATCH_W if "w" in mode else 0))
+
+    def save_state(self):               # Returns a binary save-state of registers, RAM, breakpoints and cycles
+        bps = bytearray(0x20)
+        for addr in self.breakpoints:
+            bps[addr >> 3] |= 1 << (addr & 7)
+        r = self.r
+        return STATE_HDR.pack(STATE_MAGIC, self.halt, r["OPC"], r["PC"], r["PTR"], r["R1"], r["R2"], self.cycles) \
+            + self.memory.data + bps
+
+    def load_state(self, state, breakpoints=True):  # Restores a save_state(), keeping the current breakpoints if told so
+        if len(state) != STATE_SIZE or state[:4] != STATE_MAGIC:
+            raise ValueError("Invalid save-state")
+        magic, halt, opc, pc, ptr, r1, r2, self.cycles = STATE_HDR.unpack_from(state)
+        self.r.update({"OPC": opc, "PC": pc, "PTR": ptr, "R1": r1, "R2": r2})
+        self.halt = bool(halt)
+        self.reason = None
+        if self.loops is not None:
+            self.loops.clear()
+        self.memory.load(state[STATE_HDR.size:STATE_HDR.size+0x100])
+        if breakpoints:                 # Only addresses are saved: the current conditions apply to them
+            bps = state[STATE_HDR.size+0x100:]
+            conds = {addr: cond for addr, (cond, fn) in self.breakpoints.conds.items()}
+            for addr in self.breakpoints:
+                self.breakpoints.discard(addr)
+            for addr in ((i << 3) + bit for i, byte in enumerate(bps) if byte for bit in range(8) if byte >> bit & 1):
+                self.breakpoints.add(addr, conds.get(addr))
+
+    def save(self, name):               # Keeps a named save-state in memory, or writes it to disk if name is a *.krss file
+        state = self.save_state()
+        if name.endswith(".krss"):
+            with open(name, "wb") as f:
+                f.write(state)
+        else:
+            self.states[name] = state
+        return state
+
+    def restore(self, name):            # Restores a named save-state, read from disk if name is a *.krss file
+        if name.endswith(".krss"):
+            with open(name, "rb") as f:
+                state = f.read()
+        else:
+            state = self.states[name]
+        self.load_state(state)
+        if self.history is not None:
+            self.history.clear()
+
+    def step_back(self, n=1):           # Takes the machine back n instructions, returns n, or 0 if the history doesn't reach that far
+        h = self.history
+        if h is None or not 0 < n <= self.cycles:
+            return 0
+        target = self.cycles - n
+        kf = None
+        if n > len(h):                  # Undo log exhausted: replay from the last keyframe before the target
+            kf = h.keyframe(target)
+            if kf is None:
+                return 0                # The machine is left unchanged
+        if self.loops is not None:
+            self.loops.clear()
+        if kf is None:
+            for i in range(n):
+                h.undo(self)
+            return n
+        self.load_state(kf[1], breakpoints=False)
+        h.truncate()
+        trace, profile, loops = self.trace, self.profile, self.loops
+        self.trace = self.profile = self.loops = None   # These instructions were recorded the first time
+        while self.cycles < target:
+            cpu_exec(self)
+        self.trace, self.profile, self.loops = trace, profile, loops
+        self.halt = False
+        return n
+
+    def run_back(self, max_steps=None):     # Steps back until PC reaches a breakpoint, returns a STOP_* reason
+        steps = 0
+        self.reason = STOP_MAX_STEPS
+        while steps != max_steps:
+            if not self.step_back():
+                self.reason = STOP_HISTORY
+                break
+            steps += 1
+            reason = self.breakpoints.hit(self.r)
+            if reason:
+                self.reason = reason
+                break
+        return self.reason
+
+    def snapshot(self):                 # Returns a copy of the machine state made of plain types
+        return {
+            "name"   : self.name,
+            "reason" : self.reason,
+            "halt"   : self.halt,
+            "cycles" : self.cycles,
+            "r"      : dict(self.r),
+            "memory" : bytes(self.memory.data),
+        }
+
+
+def load_program(prog, asm=None):       # Returns the content of a binary (.kris) or source (.krisa) program
+    if asm is None:
+        asm = prog.endswith(".krisa")
+    if asm:
+        import kris_asm
+        with open(prog, "r") as f:
+            image, end, errors = kris_asm.assemble_source(f.read())
+        if errors:
+            raise ValueError("%s:%d: %s" % (prog, errors[0][0], errors[0][1]))
+        return bytes(image[:end])
+    with open(prog, "rb") as f:
+        return f.read()
+
+
+def run_program(prog, asm=None, max_steps=None, breakpoints=(), run=cpu_run):  # Loads and runs a program headless
+    vm = KrisVM(engine=run)
+    vm.load(prog, asm)
+    vm.breakpoints.update(breakpoints)
+    vm.run(max_steps)
+    return vm
+
+
+def display_text(m):                    # Returns the display content as printable text
+    return "".join(get_ascii_print(b) for b in m["memory"].view[DISPLAY:])
+
+
+def dump_machine(m):                    # Returns a textual report of the machine state
+    r = m["r"]
+    retv  = "Stopped : %s\n" % m["reason"]
+    retv += "Cycles  : %d\n" % m["cycles"]
+    for reg in ["PC", "PTR", "R1", "R2"]:
+        retv += "%-8s: 0x%02x\n" % (reg, r[reg])
+    retv += "Display : |%s|\n" % display_text(m)
+    retv += "          %s\n" % " ".join("%02x" % b for b in m["memory"].view[DISPLAY:])
+    return retv
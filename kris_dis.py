@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+'''
+
+Disassembler for KRIS VM
+Author : Benjamin Evrard - @tsunulukai 🦆 - https://adelpha.be/
+
+Recursive-descent disassembly of a KRIS program: decoding starts at address
+0 and follows both ways of each JNZ, so that the bytes the control flow
+never reaches are left as data. The decoded instructions are grouped into
+basic blocks and printed as KRIS ASM, which assembles back to the same
+bytes, or as a Graphviz DOT control-flow graph:
+
+    import kris_dis
+    dis = kris_dis.Disassembly(open("helloworld.kris", "rb").read())
+    print(dis.text())
+    open("helloworld.dot", "w").write(dis.dot())
+
+R1 is tracked within each block, so that a JNZ following a SET_R1 of a
+constant only has one way out, like the "SET_R1 1; JNZ exit" idiom.
+
+'''
+
+__description__ = 'KRIS disassembler and control-flow graph builder'
+__author__      = 'Benjamin Evrard'
+
+from kris_cpu import *
+
+
+# Kind of each byte
+DATA = 0
+CODE = 1                                # Opcode of a reachable instruction
+ARG  = 2                                # Argument of a reachable instruction
+
+# Kind of each control-flow edge
+TAKEN = "taken"                         # JNZ jump
+NEXT  = "next"                          # JNZ not taken
+FLOW  = "flow"                          # Straight into the next block
+
+
+def insn_text(opcode, arg, names=None):     # Returns the KRIS ASM of an instruction, JNZ targets being named if possible
+    if not VALID[opcode]:
+        return "db 0x%02x" % opcode
+    if SIZE[opcode] == 1:
+        return MNEMONIC[opcode]
+    if opcode == OC["JNZ"] and names and arg in names:
+        return "%s %s" % (MNEMONIC[opcode], names[arg])
+    return "%s 0x%02x" % (MNEMONIC[opcode], arg)
+
+
+class DecodeCache:                      # Decoded instruction at each address, kept until its bytes get written
+    '''
+    Entries are (mnemonic, size, arg, text) tuples, text being returned by
+    fmt(pc, opcode, arg). A write hook on the whole memory drops the entries
+    covering each written address, so reading an unchanged instruction costs
+    a list lookup. generation changes on every invalidation.
+    '''
+    __slots__ = ("mem", "fmt", "entries", "generation")
+
+    def __init__(self, mem, fmt=None):
+        self.mem = mem
+        self.fmt = fmt or (lambda pc, opcode, arg: insn_text(opcode, arg))
+        self.entries = [None] * 0x100
+        self.generation = 0
+        mem.on_write(0, 0xff, self.written)
+
+    def __getitem__(self, pc):
+        entry = self.entries[pc]
+        if entry is None:
+            opcode = self.mem.data[pc]
+            arg = self.mem.data[(pc+1) & 0xff] if SIZE[opcode] == 2 and VALID[opcode] else None
+            entry = self.entries[pc] = (MNEMONIC[opcode], SIZE[opcode], arg, self.fmt(pc, opcode, arg))
+        return entry
+
+    def written(self, addr, val):       # Write hook: the byte is the opcode of an instruction or the argument of the previous one
+        if self.entries[addr] or self.entries[(addr-1) & 0xff]:
+            self.entries[addr] = self.entries[(addr-1) & 0xff] = None
+            self.generation += 1
+
+    def invalidate(self):               # Drops every entry, e.g. when the text format changes
+        self.entries = [None] * 0x100
+        self.generation += 1
+
+
+class Block:                            # Basic block: instructions up to a JNZ, HLT, invalid opcode or the next block
+    __slots__ = ("start", "insns", "succs")
+
+    def __init__(self, start):
+        self.start = start
+        self.insns = []                 # (pc, opcode, arg) tuples
+        self.succs = []                 # (address, TAKEN/NEXT/FLOW) tuples
+
+
+class Disassembly:                      # Recursive-descent disassembly and control-flow graph of a program
+    def __init__(self, content, entries=(0,), names=None):
+        content = bytes(content[:0x100])
+        self.size = len(content)
+        self.data = content + bytes(0x100 - len(content))
+        self.kind = bytearray(0x100)    # DATA, CODE or ARG per address
+        self.blocks = {}                # Blocks, indexed by start address
+        self.targets = set(entries)     # Entry points and JNZ targets
+        leaders = set(entries)
+        while True:                     # Walks the code again until no new block shows up
+            found = self.walk(leaders)
+            if found <= leaders:
+                break
+            leaders |= found
+        self.build(leaders)
+        self.names = {addr: "loc_%02x" % addr for addr in self.targets}
+        self.names.update(names or {})
+
+    def successors(self, pc, opcode, arg, r1):  # Returns the (address, kind) ways out of a JNZ, R1 being None if unknown
+        retv = []
+        if (r1 is None or r1) and arg != pc:    # A JNZ to itself halts the CPU when taken
+            retv.append((arg, TAKEN))
+        if not r1:
+            retv.append(((pc+2) & 0xff, NEXT))
+        return retv
+
+    def walk(self, leaders):            # Decodes everything reachable from the leaders, returns the blocks starts found
+        data = self.data
+        found = set()
+        todo = list(leaders)
+        seen = set()
+        while todo:
+            pc = todo.pop()
+            r1 = None                   # Value of R1, when known
+            while pc not in seen:
+                seen.add(pc)
+                if pc in leaders:
+                    r1 = None
+                opcode, arg = data[pc], data[(pc+1) & 0xff]
+                self.kind[pc] = CODE
+                if not VALID[opcode] or opcode == OC["HLT"]:
+                    break
+                if SIZE[opcode] == 2 and self.kind[(pc+1) & 0xff] == DATA:
+                    self.kind[(pc+1) & 0xff] = ARG
+                if opcode == OC["JNZ"]:
+                    self.targets.add(arg)
+                    for addr, kind in self.successors(pc, opcode, arg, r1):
+                        found.add(addr)
+                        todo.append(addr)
+                    break
+                if opcode == OC["SET_R1"]:
+                    r1 = arg
+                elif opcode in [OC["XOR"], OC["ADD"], OC["LOAD"], OC["SWAP"]]:
+                    r1 = None
+                pc = (pc + SIZE[opcode]) & 0xff
+        return found
+
+    def build(self, leaders):           # Splits the decoded code into basic blocks
+        data = self.data
+        for start in sorted(leaders):
+            block = self.blocks[start] = Block(start)
+            pc = start
+            r1 = None
+            while True:
+                opcode, arg = data[pc], data[(pc+1) & 0xff]
+                block.insns.append((pc, opcode, arg))
+                if not VALID[opcode] or opcode == OC["HLT"]:
+                    break
+                if opcode == OC["JNZ"]:
+                    block.succs = self.successors(pc, opcode, arg, r1)
+                    break
+                if opcode == OC["SET_R1"]:
+                    r1 = arg
+                elif opcode in [OC["XOR"], OC["ADD"], OC["LOAD"], OC["SWAP"]]:
+                    r1 = None
+                pc = (pc + SIZE[opcode]) & 0xff
+                if pc in leaders:
+                    block.succs = [(pc, FLOW)]
+                    break
+
+    def text(self):                     # Returns the program as KRIS ASM, data bytes included
+        kind = self.kind
+        end = self.size
+        for pc in range(0x100):
+            if kind[pc] == CODE:
+                end = max(end, pc + (SIZE[self.data[pc]] if VALID[self.data[pc]] else 1))
+        end = min(end, 0x100)
+        lines = []
+        starts = set()
+        pc = 0
+        while pc < end:
+            starts.add(pc)
+            if pc in self.names or pc in self.blocks or (kind[pc] != CODE and pc and kind[pc-1] != DATA):
+                lines.append("")
+            if pc in self.names:
+                lines.append("%s:" % self.names[pc])
+            opcode = self.data[pc]
+            if kind[pc] == CODE:
+                size = SIZE[opcode] if VALID[opcode] else 1
+                text = insn_text(opcode, self.data[(pc+1) & 0xff], self.names)
+            else:
+                size = 1
+                while pc + size < end and kind[pc+size] != CODE and pc + size not in self.names and size < 4:
+                    size += 1
+                text = "db " + ", ".join("0x%02x" % b for b in self.data[pc:pc+size])
+            op, _, arg = text.partition(" ")
+            raw = self.data[pc:pc+size]
+            lines.append(("    %-8s %-31s # %02x: %-11s %s" % (op, arg, pc, raw.hex(" "),
+                          "" if kind[pc] == CODE else "".join(map(get_ascii_print, raw)))).rstrip())
+            pc += size
+        header = ["%-12s equ 0x%02x" % (name, addr) for addr, name in sorted(self.names.items()) if addr not in starts]
+        return "\n".join(header + lines).lstrip("\n") + "\n"
+
+    def dot(self):                      # Returns the control-flow graph in Graphviz DOT format
+        colors = {TAKEN: "darkgreen", NEXT: "red", FLOW: "black"}
+        retv = 'digraph kris {\n    node [shape=box, fontname="monospace"];\n'
+        for start, block in sorted(self.blocks.items()):
+            label = "".join("0x%02x: %s\\l" % (pc, insn_text(opcode, arg, self.names)) for pc, opcode, arg in block.insns)
+            if start in self.names:
+                label = "%s:\\l%s" % (self.names[start], label)
+            retv += '    b%02x [label="%s"];\n' % (start, label)
+            for addr, kind in block.succs:
+                retv += '    b%02x -> b%02x [label="%s", color=%s];\n' % (start, addr, kind, colors[kind])
+        return retv + "}\n"
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+'''
+
+Static analyzer for KRIS VM
+Author : Benjamin Evrard - @tsunulukai 🦆 - https://adelpha.be/
+
+Abstract interpretation of a KRIS program from boot: R1, R2, PTR and every
+memory byte hold the set of values they may have, kept as a 256-bit mask.
+SET_R1 is the only source of constants and JNZ the only branch, so most
+jump conditions and pointers resolve to a handful of values:
+
+    import kris_flow
+    flow = kris_flow.Analysis(open("helloworld.kris", "rb").read())
+    print(flow.report())
+
+The analysis reports the code reached, the JNZs which are always or never
+taken, the code kris_dis decodes but no path reaches, the addresses each
+STORE can write, and whether a STORE can hit reachable code. Up to PATHS
+distinct states are kept per block before they get merged, so that short
+loops are unrolled rather than approximated.
+
+Every result but self_modifying assumes the code bytes never change: when
+self_modifying is False, this holds and the results cover every execution
+of the program from boot.
+
+'''
+
+__description__ = 'KRIS static analyzer: constant propagation and reachability'
+__author__      = 'Benjamin Evrard'
+
+from kris_cpu import *
+import kris_dis
+
+
+ALL   = (1 << 0x100) - 1                # Any byte value
+PATHS = 64                              # Distinct states kept per block before merging them
+WIDEN = 8                               # Merges of a block before its growing values are widened to ALL
+LIMIT = 0x1000                          # Value pairs computed by XOR/ADD before giving up to ALL
+
+# JNZ outcomes
+TAKEN = 1
+NEXT  = 2
+
+
+def values(mask):                       # Yields the byte values of a mask, lowest first
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def count(mask):
+    return bin(mask).count("1")
+
+
+def combine(fn, a, b):                  # Returns the mask of fn(x, y) for x in a and y in b
+    if not a or not b:
+        return 0
+    if a == ALL or b == ALL or count(a) * count(b) > LIMIT:
+        return ALL
+    retv = 0
+    for x in values(a):
+        for y in values(b):
+            retv |= 1 << fn(x, y)
+    return retv
+
+
+def ranges(mask, names=None):           # Returns the values of a mask as "0x00-0x0f, 0xa0" text
+    if mask == ALL:
+        return "any"
+    retv = []
+    for v in values(mask):
+        if retv and retv[-1][1] == v - 1:
+            retv[-1][1] = v
+        else:
+            retv.append([v, v])
+    return ", ".join(label(lo, names) if lo == hi else "0x%02x-0x%02x" % (lo, hi) for lo, hi in retv)
+
+
+def label(addr, names=None):
+    if names and addr in names:
+        return "0x%02x (%s)" % (addr, names[addr])
+    return "0x%02x" % addr
+
+
+def join(a, b, widen=False):            # Returns the union of two (R1, R2, PTR, memory) states
+    if widen:
+        return tuple(x if x | y == x else ALL for x, y in zip(a[:3], b[:3])) \
+            + (tuple(x if x | y == x else ALL for x, y in zip(a[3], b[3])),)
+    return (a[0] | b[0], a[1] | b[1], a[2] | b[2], tuple(x | y for x, y in zip(a[3], b[3])))
+
+
+class Analysis:                         # Register values, reachability and STORE targets of a program
+    def __init__(self, content, entries=(0,), names=None):
+        content = bytes(content[:0x100])
+        self.data = content + bytes(0x100 - len(content))
+        self.names = names or {}
+        self.reached = bytearray(0x100)     # kris_dis.CODE/ARG for the bytes of the instructions executed
+        self.jumps = {}                 # TAKEN/NEXT flags, indexed by JNZ address
+        self.stores = {}                # Mask of the written addresses, indexed by STORE address
+        self.loads = {}                 # Mask of the read addresses, indexed by LOAD address
+        self.stops = set()              # Addresses of the instructions which may stop the CPU
+        self.states = {}                # States at the start of each block, indexed by address
+        self.merges = {}                # Number of merges of each block whose states were merged
+        self.todo = []
+        boot = (1, 1, 1, tuple(1 << b for b in self.data))
+        for pc in entries:
+            self.merge(pc, boot)
+        while self.todo:
+            self.walk(*self.todo.pop())
+        code = 0
+        for addr in range(0x100):
+            if self.reached[addr]:
+                code |= 1 << addr
+        self.smc = {pc: mask & code for pc, mask in self.stores.items() if mask & code}
+        self.self_modifying = bool(self.smc)
+        self.self_reading = any(mask & code for mask in self.loads.values())   # Code read as data
+
+    def merge(self, pc, state):         # Adds a state to the block at pc, queuing it if something new came in
+        states = self.states.setdefault(pc, [])
+        if pc not in self.merges:
+            if state in states:
+                return
+            if len(states) < PATHS:
+                states.append(state)
+                self.todo.append((pc, state))
+                return
+            for s in states:            # Too many paths: merge them from now on
+                state = join(s, state)
+            states[:] = [state]
+            self.merges[pc] = 0
+            self.todo.append((pc, state))
+            return
+        joined = join(states[0], state, self.merges[pc] >= WIDEN)
+        if joined != states[0]:
+            states[0] = joined
+            self.merges[pc] += 1
+            self.todo.append((pc, joined))
+
+    def walk(self, pc, state):          # Executes the block at pc on a state, passing it to the following blocks
+        data = self.data
+        r1, r2, ptr, mem = state[0], state[1], state[2], list(state[3])
+        start = pc
+        seen = set()
+        while True:
+            if (pc != start and pc in self.states) or pc in seen:
+                self.merge(pc, (r1, r2, ptr, tuple(mem)))     # Known block, or code wrapping around onto itself
+                return
+            seen.add(pc)
+            opcode, arg = data[pc], data[(pc+1) & 0xff]
+            self.reached[pc] = kris_dis.CODE
+            if not VALID[opcode] or opcode == OC["HLT"]:
+                self.stops.add(pc)
+                return
+            if SIZE[opcode] == 2 and not self.reached[(pc+1) & 0xff]:
+                self.reached[(pc+1) & 0xff] = kris_dis.ARG
+            if opcode == OC["XOR"]:
+                r1 = combine(lambda x, y: x ^ y, r1, r2)
+            elif opcode == OC["ADD"]:
+                r1 = combine(lambda x, y: (x + y) & 0xff, r1, r2)
+            elif opcode == OC["LOAD"]:
+                self.loads[pc] = self.loads.get(pc, 0) | ptr
+                r1 = 0
+                for addr in values(ptr):
+                    r1 |= mem[addr]
+            elif opcode == OC["STORE"]:
+                self.stores[pc] = self.stores.get(pc, 0) | ptr
+                if count(ptr) == 1:
+                    mem[ptr.bit_length() - 1] = r1
+                else:
+                    for addr in values(ptr):
+                        mem[addr] |= r1
+            elif opcode == OC["SET_PTR"]:
+                ptr = r1
+            elif opcode == OC["SWAP"]:
+                r1, r2 = r2, r1
+            elif opcode == OC["SET_R1"]:
+                r1 = 1 << arg
+            elif opcode == OC["JNZ"]:
+                taken, zero = r1 & ~1, r1 & 1
+                self.jumps[pc] = self.jumps.get(pc, 0) | (TAKEN if taken else 0) | (NEXT if zero else 0)
+                if taken:
+                    if arg == pc:       # JNZ to itself: the CPU halts
+                        self.stops.add(pc)
+                    else:
+                        self.merge(arg, (taken, r2, ptr, tuple(mem)))
+                if zero:
+                    self.merge((pc+2) & 0xff, (zero, r2, ptr, tuple(mem)))
+                return
+            pc = (pc + SIZE[opcode]) & 0xff
+
+    def unreachable(self):              # Returns the (lo, hi) ranges kris_dis decodes as code, but no path reaches
+        dis = kris_dis.Disassembly(self.data)
+        retv = []
+        for addr in range(0x100):
+            if dis.kind[addr] != kris_dis.DATA and not self.reached[addr]:
+                if retv and retv[-1][1] == addr - 1:
+                    retv[-1][1] = addr
+                else:
+                    retv.append([addr, addr])
+        return [tuple(r) for r in retv]
+
+    def report(self):                   # Returns the analysis results as text
+        names = self.names
+        lines = ["Code reached     %d instructions, %d bytes" % (
+            sum(1 for k in self.reached if k == kris_dis.CODE), sum(1 for k in self.reached if k))]
+        dead = self.unreachable()
+        lines.append("Unreachable code %s" % (", ".join(
+            "0x%02x-0x%02x" % (lo, hi) if lo != hi else "0x%02x" % lo for lo, hi in dead) or "none"))
+        outcome = {TAKEN: "always taken", NEXT: "never taken", TAKEN | NEXT: "taken or not"}
+        for pc, flags in sorted(self.jumps.items()):
+            lines.append("JNZ   %-10s %-14s -> %s" % ("0x%02x" % pc, outcome[flags], label(self.data[(pc+1) & 0xff], names)))
+        for pc, mask in sorted(self.stores.items()):
+            lines.append("STORE %-10s writes %s" % ("0x%02x" % pc, ranges(mask, names)))
+        lines.append("Stops            %s" % (", ".join("0x%02x" % pc for pc in sorted(self.stops)) or "never"))
+        if self.self_modifying:
+            lines.append("Self-modifying   yes")
+            for pc, mask in sorted(self.smc.items()):
+                lines.append("    STORE 0x%02x may write code at %s" % (pc, ranges(mask)))
+        else:
+            lines.append("Self-modifying   no")
+        return "\n".join(lines) + "\n"
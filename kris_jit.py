@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+'''
+
+Basic block translation cache for KRIS VM
+Author : Benjamin Evrard - @tsunulukai 🦆 - https://adelpha.be/
+
+JNZ is the only control flow instruction of the KRIS, so the straight-line
+code between two jumps is translated into a single Python function which
+runs the whole block's register and memory effects in one call:
+
+    import kris_cpu, kris_jit
+    m = kris_cpu.run_program("helloworld.krisa", run=kris_jit.jit_run)
+
+Translated blocks are cached by start address. Their bytes are flagged with
+Memory.HOOK_X, so that any write into them (self-modifying code, debugger
+edits, program loads) invalidates the blocks covering the written address.
+Programs which kris_flow proves can't modify their code may use a
+BlockCache(mem, smc=False), whose STOREs don't check for translated code.
+When the memory has no write hooks either, these STOREs write the bytes
+directly, without calling Memory.write(): the dirty range isn't tracked,
+and write hooks registered after the translation aren't called.
+
+'''
+
+__description__ = 'KRIS basic block translation cache'
+__author__      = 'Benjamin Evrard'
+
+from kris_cpu import *
+
+
+MAX_BLOCK = 64                          # Maximum number of instructions per block
+MAX_CODE  = 4096                        # Maximum number of compiled blocks kept across machines
+
+# Python translation of each instruction, registers being held in locals
+TRANSLATION = {
+    OC["XOR"]     : "R1 ^= R2",
+    OC["ADD"]     : "R1 = (R1 + R2) & 0xff",
+    OC["SET_PTR"] : "PTR = R1",
+    OC["SWAP"]    : "R1, R2 = R2, R1",
+    OC["SET_R1"]  : "R1 = 0x%02x",
+}
+
+
+code_cache = {}                         # Compiled code objects, indexed by generated source code
+
+
+class Block:                            # A translated basic block
+    __slots__ = ("start", "end", "n", "fn", "source")
+
+    def __init__(self, start, end, n, fn, source):
+        self.start  = start             # Address of the first instruction
+        self.end    = end               # Address following the last instruction byte
+        self.n      = n                 # Number of instructions
+        self.fn     = fn                # fn(r) -> (executed instructions, STOP_* reason or None)
+        self.source = source            # Generated Python source code
+
+
+class BlockCache:                       # Translated blocks of a machine, indexed by start address
+    def __init__(self, mem, breakpoints=(), smc=True):
+        self.mem = mem
+        self.blocks = [None] * 0x100
+        self.owners = [[] for i in range(0x100)]    # Start addresses of the blocks covering each address
+        self.breakpoints = frozenset(breakpoints)
+        self.smc = smc                  # False when no STORE can hit the code (see kris_flow), so they aren't checked
+        self.translated = 0
+        self.invalidated = 0
+        mem.xhook = self.invalidate
+
+    def invalidate(self, lo, hi):       # Drops the blocks covering an address in [lo, hi]
+        for addr in range(lo, hi+1):
+            for start in list(self.owners[addr]):
+                self.drop(start)
+
+    def drop(self, start):
+        block = self.blocks[start]
+        self.blocks[start] = None
+        self.invalidated += 1
+        for addr in range(block.start, block.end):
+            self.owners[addr].remove(start)
+            if not self.owners[addr]:
+                self.mem.hooked[addr] &= ~Memory.HOOK_X
+
+    def flush(self):
+        for start in range(0x100):
+            if self.blocks[start]:
+                self.drop(start)
+
+    def get(self, pc):                  # Returns the block starting at pc, translating it if needed
+        block = self.blocks[pc]
+        if block is None:
+            block = self.translate(pc)
+            if block:
+                self.blocks[pc] = block
+                self.translated += 1
+                for addr in range(block.start, block.end):
+                    self.owners[addr].append(pc)
+                    self.mem.hooked[addr] |= Memory.HOOK_X
+        return block
+
+    def translate(self, start):         # Returns a Block for the code at start, or None if it can't be translated
+        data = self.mem.data
+        rd = "rd(PTR)" if self.mem.rhooks else "d[PTR]"
+        save = "r[\"R1\"] = R1; r[\"R2\"] = R2; r[\"PTR\"] = PTR"
+        src = ["def block(r):",
+               "    R1 = r[\"R1\"]; R2 = r[\"R2\"]; PTR = r[\"PTR\"]"]
+        pc = last = start
+        n = 0
+        jump = False
+        while n < MAX_BLOCK:
+            op = data[pc]
+            if not VALID[op] or op == OC["HLT"] or pc + SIZE[op] > 0x100:
+                break                   # Left to the interpreter
+            if n and pc in self.breakpoints:
+                break
+            n += 1
+            arg = data[pc+1] if SIZE[op] == 2 else 0
+            src.append("    # 0x%02x: %s" % (pc, MNEMONIC[op]))
+            if op in TRANSLATION:
+                src.append("    " + (TRANSLATION[op] % arg if SIZE[op] == 2 else TRANSLATION[op]))
+            elif op == OC["LOAD"]:
+                src.append("    R1 = %s" % rd)
+            elif op == OC["STORE"] and not self.smc:
+                src.append("    wr(PTR, R1)" if self.mem.whooks else "    d[PTR] = R1")
+            elif op == OC["STORE"]:     # Leave the block if the store hits translated code
+                src.append("    x = hk[PTR] & %d" % Memory.HOOK_X)
+                src.append("    wr(PTR, R1)")
+                src.append("    if x:")
+                src.append("        %s; r[\"OPC\"] = 0x%02x; r[\"PC\"] = 0x%02x" % (save, pc, (pc+1) & 0xff))
+                src.append("        return %d, None" % n)
+            elif op == OC["JNZ"]:
+                src.append("    %s; r[\"OPC\"] = 0x%02x" % (save, pc))
+                src.append("    if R1:")
+                src.append("        r[\"PC\"] = 0x%02x" % arg)
+                src.append("        return %d, %s" % (n, "STOP_LOOP" if arg == pc else "None"))
+                src.append("    r[\"PC\"] = 0x%02x" % ((pc+2) & 0xff))
+                src.append("    return %d, None" % n)
+                jump = True
+            last = pc
+            pc += SIZE[op]
+            if jump:
+                break
+        if not n:
+            return None
+        if not jump:
+            src.append("    %s; r[\"OPC\"] = 0x%02x; r[\"PC\"] = 0x%02x" % (save, last, pc & 0xff))
+            src.append("    return %d, None" % n)
+        source = "\n".join(src) + "\n"
+        code = code_cache.get(source)
+        if code is None:
+            if len(code_cache) >= MAX_CODE:
+                code_cache.clear()
+            code = code_cache[source] = compile(source, "<kris block 0x%02x>" % start, "exec")
+        ns = {"d": self.mem.data, "hk": self.mem.hooked, "wr": self.mem.write, "rd": self.mem.read, "STOP_LOOP": STOP_LOOP}
+        exec(code, ns)
+        return Block(start, pc, n, ns["block"], source)
+
+
+def jit_run(m, max_steps=None, breakpoints=()):   # Same as cpu_run, executing translated blocks when possible
+    if (m["trace"] is not None and m["trace"].level) or m.get("history") is not None or m.get("profile") is not None \
+            or m.get("loops") is not None or m["memory"].watches \
+            or getattr(breakpoints, "conds", None) or getattr(breakpoints, "when", None):
+        return cpu_run(m, max_steps, breakpoints)     # Blocks neither record instructions nor check watchpoints, conditions or loops
+    r = m["r"]
+    mem = m["memory"]
+    cache = m.get("jit")
+    if cache is None or cache.breakpoints != frozenset(breakpoints):
+        if cache:
+            cache.flush()
+        cache = m["jit"] = BlockCache(mem, breakpoints)
+    blocks = cache.blocks
+    data = mem.data
+    bps = bp_bitmap(breakpoints)
+    steps = 0
+    reason = None
+    if max_steps is None:
+        max_steps = -1
+    while steps != max_steps:
+        pc = r["PC"]
+        block = blocks[pc] or cache.get(pc)
+        if block and (max_steps < 0 or block.n <= max_steps - steps):
+            n, reason = block.fn(r)
+            steps += n
+        else:
+            r["OPC"] = pc
+            reason = DISPATCH[data[pc]](r, mem, pc)
+            steps += 1
+        if reason is not None:
+            break
+        if bps[r["PC"]]:
+            reason = STOP_BREAKPOINT
+            break
+    else:
+        reason = STOP_MAX_STEPS
+    m["cycles"] += steps
+    if reason in [STOP_HALT, STOP_LOOP]:
+        m["halt"] = True
+    m["reason"] = reason
+    return reason
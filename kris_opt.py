@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+
+'''
+
+Peephole optimizer for KRIS VM
+Author : Benjamin Evrard - @tsunulukai 🦆 - https://adelpha.be/
+
+Rewrites a KRIS ASM source into a shorter one which stops in the same
+state, once assembled and run:
+
+    import kris_opt
+    opt = kris_opt.Optimization(open("helloworld.krisa").read())
+    print(opt.report())
+    open("helloworld.kris", "wb").write(opt.after.image[:opt.after.end])
+
+The basic blocks of the kris_dis control-flow graph are scanned with the
+values each register holds (value numbering) and the registers read further
+on (liveness). Instructions get removed, one block per round, when they are:
+  - a SET_R1, SET_PTR or LOAD of the value the register holds already, a
+    STORE of the value the memory holds already, a SWAP of equal values
+  - a SWAP pair, or a SWAP before an ADD or XOR (which commute) when R2 isn't
+    read afterwards
+  - computing a value which is never read
+  - a JNZ which is never taken (kris_flow) or jumps to the next instruction
+  - code which no path reaches (kris_flow)
+R1, R2 and PTR are read by whoever looks at a stopped machine, so they stay
+live at HLT and JNZ $. Instructions are only removed, never added nor
+changed, and labels and comments are kept: the source is assembled again,
+so the code and data that follow move down, as do the labels pointing to
+them. Only sources whose JNZs jump to labels (or $) are optimized; programs
+jumping to literal addresses, whose STOREs may hit their code, whose LOADs
+may read it, or whose code depends on its own addresses are left alone.
+
+The optimized program is then run against the original one, and dropped
+unless both stop for the same reason on the same instruction, with the same
+display, and with the same R1, R2, PTR and bytes written by the program
+once the moves are accounted for: an address in the original program
+stands for where its byte moved, and a value may be either the original
+one or where the byte at that address moved (a pointer into moved data).
+When neither program stops within the verification budget, only their stop
+reasons and displays are compared.
+
+'''
+
+__description__ = 'KRIS ASM peephole optimizer'
+__author__      = 'Benjamin Evrard'
+
+from kris_cpu import *
+from kris_asm import Assembly, LINE_RE, TOKEN_RE, evaluate, statement
+from kris_jit import jit_run
+import itertools
+import kris_dis
+import kris_flow
+
+
+VERIFY_STEPS = 1000000                  # Step budget of the runs comparing the original and optimized programs
+ROUNDS       = 0x100                    # Maximum number of optimization rounds
+
+# Registers, as liveness bits
+R1  = 1
+R2  = 2
+PTR = 4
+
+USES = {OC["XOR"]: R1 | R2, OC["ADD"]: R1 | R2, OC["LOAD"]: PTR, OC["STORE"]: PTR | R1, OC["SET_PTR"]: R1,
+        OC["SWAP"]: R1 | R2, OC["SET_R1"]: 0, OC["JNZ"]: R1, OC["HLT"]: 0}
+DEFS = {OC["XOR"]: R1, OC["ADD"]: R1, OC["LOAD"]: R1, OC["STORE"]: 0, OC["SET_PTR"]: PTR,
+        OC["SWAP"]: R1 | R2, OC["SET_R1"]: R1, OC["JNZ"]: 0, OC["HLT"]: 0}
+PURE = {OC["XOR"], OC["ADD"], OC["LOAD"], OC["SET_PTR"], OC["SWAP"], OC["SET_R1"]}    # No effect but their registers
+
+ZERO = ("val", 0)
+
+
+def liveness(insns, live):              # Returns the registers live before each instruction, then after the last one
+    retv = [live]
+    for pc, opcode, arg, args in reversed(insns):
+        if opcode == OC["SWAP"]:
+            live = (R1 if live & R2 else 0) | (R2 if live & R1 else 0) | (live & PTR)
+        else:
+            live = live & ~DEFS[opcode] | USES[opcode]
+        retv.append(live)
+    return retv[::-1]
+
+
+def self_jumps(prog):                   # Returns the number of JNZs to themselves of an assembled program
+    return sum(1 for n, p, data, line in prog.rows if len(data) == 2 and data[0] == OC["JNZ"] and data[1] == p)
+
+
+def strip(line):                        # Returns a source line without its instruction, None if nothing else is left
+    m = LINE_RE.match(line)
+    rest = line[:m.start("op")].rstrip()
+    return rest if rest.strip() else None
+
+
+class Optimization:                     # A KRIS ASM source and its optimized version
+    '''
+    Holds the original (before) and optimized (after) Assembly, the optimized
+    source, the (line number, source line, reason) of the removed
+    instructions, the number of bytes saved, the reason why the source was
+    left alone (skipped, or None), and the instructions executed by each
+    program (steps) when both stopped within the verification budget.
+    '''
+    def __init__(self, src, steps=VERIFY_STEPS):
+        self.before = self.after = Assembly(src)
+        self.source = src
+        self.removed = []
+        self.saved = 0
+        self.skipped = None
+        self.steps = None
+        self.fresh = itertools.count()
+        if self.before.errors:
+            self.skipped = "the source doesn't assemble"
+            return
+        lines = src.split("\n")
+        keep = set()                    # Source lines not to remove
+        prog = self.before
+        for _ in range(ROUNDS):
+            alive = [i for i, line in enumerate(lines) if line is not None]
+            rows = {p: (alive[n-1], data) for n, p, data, line in prog.rows if data}
+            todo = self.round(prog, {p for p, (i, data) in rows.items() if i in keep})
+            if not todo:
+                break
+            edited = list(lines)
+            for pc in todo:
+                edited[rows[pc][0]] = strip(edited[rows[pc][0]])
+            new = Assembly("\n".join(line for line in edited if line is not None))
+            if self_jumps(new) > self_jumps(prog):  # A loop shrank down to a JNZ to itself, which halts
+                keep.add(rows[min(todo)][0])
+                continue
+            for pc, reason in sorted(todo.items()):
+                i, data = rows[pc]
+                self.removed.append((i+1, lines[i].strip(), reason))
+                self.saved += len(data)
+            lines, prog = edited, new
+        if self.removed:
+            self.skipped = None         # A later round couldn't go on, the previous ones still hold
+        else:
+            return
+        source = "\n".join(line for line in lines if line is not None)
+        after = Assembly(source)
+        alive = [i for i, line in enumerate(lines) if line is not None]
+        runs = []
+        for prog, index in [(self.before, lambda n: n-1), (after, lambda n: alive[n-1])]:
+            vm = KrisVM(prog.image[:prog.end], engine=jit_run)
+            written = set()
+            vm.memory.on_write(0, 0xff, lambda addr, val, written=written: written.add(addr))
+            vm.run(steps)
+            at = {p: index(n) for n, p, data, line in prog.rows if data}    # Source line of each instruction
+            runs.append((vm, at.get(vm.r["PC"], vm.r["PC"]), written))
+        (old, old_at, old_written), (new, new_at, new_written) = runs
+        differ = self.differ(old, new, old_at, new_at, self.moves(after, alive), old_written, new_written)
+        if differ:
+            self.skipped = "the optimized program %s" % differ
+            self.removed, self.saved = [], 0
+            return
+        if old.reason != STOP_MAX_STEPS:
+            self.steps = (old.cycles, new.cycles)
+        self.after = after
+        self.source = source
+        self.removed.sort()
+
+    def moves(self, after, alive):      # Returns {original address: optimized address} of the bytes which were kept
+        retv = {}
+        lines = {alive[n-1]: p for n, p, data, line in after.rows if data}
+        used = set()                    # Addresses holding a byte of either program
+        for prog in [self.before, after]:
+            for n, p, data, line in prog.rows:
+                used.update(range(p, p+len(data)))
+        for n, p, data, line in self.before.rows:
+            if data and n-1 in lines:
+                for i in range(len(data)):
+                    retv[p+i] = lines[n-1] + i
+        for addr in range(0x100):       # Free memory stays where it is
+            if addr not in used:
+                retv[addr] = addr
+        return retv
+
+    def differ(self, old, new, old_at, new_at, moves, old_written, new_written):    # Returns how the final states of two runs differ, None if they don't
+        if old.reason != new.reason:
+            return "stops for another reason"
+        if old.memory.data[DISPLAY:] != new.memory.data[DISPLAY:]:
+            return "displays something else"
+        if old.reason == STOP_MAX_STEPS:    # Both stopped at different points of their run
+            return None
+        if old_at != new_at:
+            return "stops on another instruction"
+        same = lambda a, b: a == b or moves.get(a) == b
+        for reg in ["R1", "R2", "PTR"]:
+            if not same(old.r[reg], new.r[reg]):
+                return "ends with another %s" % reg
+        for addr in sorted(old_written):
+            if addr not in moves or not same(old.memory.data[addr], new.memory.data[moves[addr]]):
+                return "ends with another value at 0x%02x" % addr
+        if new_written - {moves.get(addr) for addr in old_written}:
+            return "writes other addresses"
+        return None
+
+    def round(self, prog, keep):        # Returns the {address: reason} of the instructions to remove from prog
+        image = bytes(prog.image[:prog.end])
+        flow = kris_flow.Analysis(image)
+        if flow.self_modifying or flow.self_reading:
+            self.skipped = "the program may %s its own code" % ("modify" if flow.self_modifying else "read")
+            return {}
+        insns = {}
+        labels = self.labels = set(prog.symbols) - prog.consts
+        self.symbols = prog.symbols
+        for n, p, data, line in prog.rows:
+            op, args = statement(LINE_RE.match(line))
+            if not data or op == "DB":
+                continue
+            if args and "$" in args and not (op == "JNZ" and args.strip() == "$"):
+                self.skipped = "line %d depends on its own address" % n
+                return {}
+            if op == "JNZ" and args.strip() not in labels | {"$"}:
+                self.skipped = "line %d jumps to a literal address" % n
+                return {}
+            insns[p] = args
+        dis = kris_dis.Disassembly(image)
+        blocks = {}
+        for start, block in dis.blocks.items():
+            if not flow.reached[start]:
+                continue
+            if any(pc not in insns for pc, opcode, arg in block.insns):
+                self.skipped = "code at 0x%02x isn't an instruction of the source" % start
+                return {}
+            blocks[start] = [(pc, opcode, arg, insns[pc]) for pc, opcode, arg in block.insns]
+        dead = [pc for lo, hi in flow.unreachable() for pc in range(lo, hi+1) if pc in insns and pc not in keep]
+        if dead:
+            return {pc: "unreachable" for pc in dead}
+        outcome = {kris_dis.TAKEN: kris_flow.TAKEN, kris_dis.NEXT: kris_flow.NEXT}
+        succs = {}
+        for start in blocks:            # Drops the JNZ ways kris_flow proves never followed
+            block = dis.blocks[start]
+            flags = flow.jumps.get(block.insns[-1][0], kris_flow.TAKEN | kris_flow.NEXT)
+            succs[start] = [(addr, kind) for addr, kind in block.succs if kind == kris_dis.FLOW or flags & outcome[kind]]
+        preds = {start: [] for start in blocks}
+        for start in blocks:
+            for addr, kind in succs[start]:
+                preds[addr].append((start, kind))
+        stops = {start for start in blocks if blocks[start][-1][0] in flow.stops}
+        live_in = {start: 0 for start in blocks}
+        changed = True
+        while changed:                  # Liveness across blocks, until it settles
+            changed = False
+            for start in blocks:
+                live = liveness(blocks[start], self.live_out(succs[start], live_in, start in stops))[0]
+                if live != live_in[start]:
+                    live_in[start] = live
+                    changed = True
+        for start in sorted(blocks):
+            state = self.entry(start, preds[start], blocks)
+            left = list(blocks[start])
+            todo = {}
+            while True:                 # Removes instructions one by one, until the block settles
+                found = self.scan(left, state, self.live_out(succs[start], live_in, start in stops), flow, keep)
+                if not found:
+                    break
+                indexes, reason = found
+                for i in sorted(indexes, reverse=True):
+                    todo[left[i][0]] = reason
+                    del left[i]
+            if todo:
+                return todo
+        return {}
+
+    def live_out(self, succs, live_in, stop=False):     # Registers live after a block: all of them where it may stop
+        live = R1 | R2 | PTR if stop else 0
+        for addr, kind in succs:
+            live |= live_in[addr]
+        return live
+
+    def key(self, args):                # Returns the value of a SET_R1 operand, labels being kept by name
+        for m in TOKEN_RE.finditer(args):
+            if m["name"] in self.labels:
+                return ("sym", "".join(args.split()))
+        return ("val", evaluate(args, self.symbols) & 0xff)
+
+    def entry(self, start, preds, blocks):  # Returns the (R1, R2, PTR, memory) values at the start of a block
+        if not preds and start == 0:
+            return (ZERO, ZERO, ZERO, {})
+        if len(preds) != 1 or preds[0][0] == start:
+            return self.unknown()
+        src, kind = preds[0]
+        r1, r2, ptr, mem = self.unknown()
+        for insn in blocks[src]:
+            r1, r2, ptr, mem = self.step(insn, (r1, r2, ptr, mem))
+        if kind == kris_dis.NEXT:
+            r1 = ZERO
+        return (r1, r2, ptr, mem)
+
+    def unknown(self):
+        return (("id", next(self.fresh)), ("id", next(self.fresh)), ("id", next(self.fresh)), {})
+
+    def step(self, insn, state):        # Returns the values after an instruction
+        pc, opcode, arg, args = insn
+        r1, r2, ptr, mem = state
+        if opcode == OC["SET_R1"]:
+            r1 = self.key(args)
+        elif opcode == OC["SET_PTR"]:
+            ptr = r1
+        elif opcode == OC["SWAP"]:
+            r1, r2 = r2, r1
+        elif opcode == OC["LOAD"]:
+            r1 = mem.get(ptr) or ("id", next(self.fresh))
+            mem = dict(mem)
+            mem[ptr] = r1
+        elif opcode == OC["STORE"]:
+            mem = {ptr: r1}             # Other pointers may hold the same address
+        elif opcode in [OC["XOR"], OC["ADD"]]:
+            if r1[0] == r2[0] == "val":
+                r1 = ("val", r1[1] ^ r2[1] if opcode == OC["XOR"] else (r1[1] + r2[1]) & 0xff)
+            elif opcode == OC["XOR"] and r1 == r2:
+                r1 = ZERO
+            else:
+                r1 = ("id", next(self.fresh))
+        return (r1, r2, ptr, mem)
+
+    def scan(self, insns, state, live, flow, keep):     # Returns the ([indexes], reason) of the first removable instructions
+        after = liveness(insns, live)[1:]
+        for i, insn in enumerate(insns):
+            for indexes, reason in self.rules(insns, i, after, state, flow):
+                if not any(insns[j][0] in keep for j in indexes):
+                    return indexes, reason
+            state = self.step(insn, state)
+        return None
+
+    def rules(self, insns, i, after, state, flow):  # Yields the ([indexes], reason) removals possible at insns[i]
+        pc, opcode, arg, args = insns[i]
+        r1, r2, ptr, mem = state
+        nxt = insns[i+1][1] if i+1 < len(insns) else None
+        if opcode in PURE and not DEFS[opcode] & after[i]:
+            yield [i], "result never read"
+        if opcode == OC["SWAP"]:
+            if nxt == OC["SWAP"]:
+                yield [i, i+1], "SWAP pair"
+            if r1 == r2:
+                yield [i], "R1 and R2 hold the same value"
+            if nxt in [OC["ADD"], OC["XOR"]] and not after[i+1] & R2:
+                yield [i], "%s commutes and R2 isn't read afterwards" % MNEMONIC[nxt]
+        elif opcode == OC["SET_R1"] and self.key(args) == r1:
+            yield [i], "R1 holds this value already"
+        elif opcode == OC["SET_PTR"] and ptr == r1:
+            yield [i], "PTR holds this value already"
+        elif opcode == OC["LOAD"] and ptr in mem and mem[ptr] == r1:
+            yield [i], "R1 holds this memory byte already"
+        elif opcode == OC["STORE"] and ptr in mem and mem[ptr] == r1:
+            yield [i], "memory holds this value already"
+        elif opcode == OC["JNZ"]:
+            if r1 == ZERO or flow.jumps.get(pc) == kris_flow.NEXT:
+                yield [i], "never taken"
+            if arg == (pc+2) & 0xff:
+                yield [i], "jumps to the next instruction"
+
+    def instructions(self, prog):       # Returns the number of instructions of an assembled program
+        return sum(1 for n, p, data, line in prog.rows if data and statement(LINE_RE.match(line))[0] != "DB")
+
+    def report(self):                   # Returns what was saved and removed, as text
+        if self.skipped:
+            return "Left unchanged: %s\n" % self.skipped
+        lines = ["Bytes            %d -> %d, %d saved" % (self.before.end, self.after.end, self.saved),
+                 "Instructions     %d -> %d" % (self.instructions(self.before), self.instructions(self.after))]
+        if self.steps:
+            lines.append("Executed         %d -> %d" % self.steps)
+        else:
+            lines.append("Executed         unknown, the program doesn't stop within the verification budget")
+        for n, line, reason in self.removed:
+            lines.append("    line %-4d %-24s %s" % (n, line.split("#")[0].strip(), reason))
+        return "\n".join(lines) + "\n"
@@ -11,8 +11,11 @@ __description__ = 'KRIS Debugger UI routines'
 __author__      = 'Benjamin Evrard'
 
 import datetime
+import functools
 import os
+import re
 import sys
+import threading
 import time
 
 starttime = time.time()
@@ -117,6 +120,96 @@ cur_posn = {
 
 boxes={}
 
+# Frame buffer
+# Drawing routines write (style, character) cells into a back buffer; flush_frame()
+# compares it with the front buffer (what the terminal currently shows) and sends
+# only the cells that changed, in a single write.
+SCREEN_W = 100
+SCREEN_H = 45
+BLANK    = ("", " ")
+SGR      = re.compile("(\033\\[[0-9;]*m)")         # ANSI Select Graphic Rendition codes
+WIDE     = set("🦆") | set(CLOCK.values())          # Characters drawn over 2 columns
+WIDE_RE  = re.compile("[%s]" % "".join(sorted(WIDE)))
+
+back        = [[BLANK] * SCREEN_W for y in range(SCREEN_H)]
+front       = [[BLANK] * SCREEN_W for y in range(SCREEN_H)]
+line_cache  = {}                                    # (x, y) -> (string, cells) of the last put() there
+screen_lock = threading.Lock()
+
+
+def put(x, y, s):                       # Writes a string into the frame buffer at a given position
+    if y < 1 or y > SCREEN_H or x < 1 or x > SCREEN_W:
+        return
+    with screen_lock:                  # The clock thread flushes frames while the main thread draws
+        row = back[y-1]
+        cached = line_cache.get((x, y))
+        if cached and cached[0] == s and row[x-1:x-1+len(cached[1])] == cached[1]:
+            return
+        cells = []
+        style = ""
+        for i, part in enumerate(SGR.split(s)):
+            if i & 1:
+                style = "" if part == C["R"] else style + part
+            else:
+                for ch in part:
+                    if ch < " ":                        # Control characters don't move the cursor
+                        ch = " "
+                    cells.append((style, ch))
+                    if ch in WIDE:
+                        cells.append((style, ""))
+        cells = cells[:SCREEN_W-x+1]
+        end = x-1+len(cells)
+        if x > 1 and not row[x-1][1] and cells:         # Overwriting the right half of a wide character
+            row[x-2] = (row[x-2][0], " ")
+        if end < SCREEN_W and not row[end][1]:          # Overwriting the left half of a wide character
+            row[end] = (row[end][0], " ")
+        row[x-1:end] = cells
+        line_cache[(x, y)] = (s, cells)
+
+
+def flush_frame(keep_cursor=False):     # Sends the cells that changed since the last flush to the terminal
+    out = []
+    with screen_lock:
+        for y in range(SCREEN_H):
+            b = back[y]
+            f = front[y]
+            if b == f:
+                continue
+            x = 0
+            style = None
+            while x < SCREEN_W:
+                if b[x] == f[x]:
+                    x += 1
+                    continue
+                if x and not b[x][1]:               # Continuation of a wide character: redraw its head
+                    x -= 1
+                out.append("\033[%d;%dH" % (y+1, x+1))
+                first = True
+                while x < SCREEN_W and (first or b[x] != f[x] or not b[x][1]):
+                    cell = b[x]
+                    if cell[1]:
+                        if cell[0] != style:
+                            style = cell[0]
+                            out.append(C["R"] + style)
+                        out.append(cell[1])
+                    f[x] = cell
+                    x += 1
+                    first = False
+        if out:
+            out.append(C["R"])
+            if keep_cursor:
+                out.insert(0, "\033[s")
+                out.append("\033[u")
+            stdo_wf("".join(out))
+
+
+def invalidate(y=None):                 # Forces lines (all by default) to be sent again on the next flush
+    with screen_lock:
+        for i in range(SCREEN_H) if y is None else [y-1]:
+            if 0 <= i < SCREEN_H:
+                front[i] = [None] * SCREEN_W
+
+
 def prn(s, end=""):
     #stdwf(s+end)
     print(s, end=end, flush=True)
@@ -140,7 +233,6 @@ def cur_set(x,y):                       # Sets the cursor position
 
 
 def draw_line_h(x,y,l,p,c=C["LINE"]):   # Draws an horizontal line
-    cur_set(x,y)
     if p == "t":
         dl = "┌"
         dr = "┐"
@@ -149,12 +241,11 @@ def draw_line_h(x,y,l,p,c=C["LINE"]):   # Draws an horizontal line
         dr = "┘"
     else:
         dl = dr = "─"
-    prn("%s%s%s%s%s" % (c,dl,"─"*(l-2),dr,C["R"]))
+    put(x, y, "%s%s%s%s%s" % (c,dl,"─"*(l-2),dr,C["R"]))
 
 
 def draw_line_v(x,y,l,p,c=C["LINE"]):   # Draws an vertical line
     for i in range (l):
-        cur_set(x,y+i)
         if i == 0 :
             if p == "l":
                 d = "┌"
@@ -167,7 +258,7 @@ def draw_line_v(x,y,l,p,c=C["LINE"]):   # Draws an vertical line
                 d="┘"
         else:
             d = "│"
-        prn("%s%s%s" % (c,d,C["R"]))
+        put(x, y+i, "%s%s%s" % (c,d,C["R"]))
 
 
 def draw_square(box):                   # Draws a square from a box object
@@ -205,13 +296,12 @@ def draw_box(box):                      # Draws a box and its title from a box o
         
         if "ct" in box:
             c = box["ct"]
-        cur_set(box["tl"]["x"]+2+to, box["tl"]["y"])
         if "align" not in box:
             str = "[%s%s%s]" % (c,box["title"],C["R"])
         else:
             if box["align"] == "center":
                 str = "%s[%s]%s" % (c, box["title"].center(box["br"]["x"] - box["tl"]["x"]-5), C["R"])
-        prn(str)
+        put(box["tl"]["x"]+2+to, box["tl"]["y"], str)
 
 
 def draw_box_content(content, box, a="left", c=""):     # Prints contents into a box
@@ -234,49 +324,43 @@ def draw_box_content(content, box, a="left", c=""):     # Prints contents into a
 
 
 def print_box_line(x,y,lenght,content,align="left"): # Prints a line at a given position with a constrained lenght 
-    cur_set(x-1, y)
-    oversized = False
-    if len(strip_acc(content)) > lenght:
-        oversized = True
-        align = "left"
-    while len(strip_acc(content)) > lenght:
-        content = content[:-1]
-    padding = " " * (lenght-len(strip_acc(content))+1)
-    if align == "left":
-        prn(" %s%s%s" % (content[:lenght+acc_len(content)], padding, C["R"]), end="")
-        if oversized:
-            cur_set(x+lenght-1, y)
-            prn("…")
-    if align == "center":
-        prn(content.center(lenght) + C["R"], end="")
-
-
-def ansi_cc():                          # Returns a list of ANSI Control Codes
-    retv = []
-    retv += C["F"]["D"].values()
-    retv += C["F"]["L"].values()
-    retv += C["B"]["D"].values()
-    retv += C["A"]["S"].values()
-    retv += C["A"]["R"].values()
-    return retv
-
-def long_uchar():
-    retv = []
-    retv += "🦆"
-    retv += CLOCK.values()
-    return retv
+    if visible_width(content) > lenght:                 # Oversized: ends with "…" in the last column
+        content, w = truncate(content, lenght-1)
+        put(x-1, y, " %s%s%s… " % (content, C["R"], " " * (lenght-1-w)))
+    elif align == "left":
+        put(x-1, y, " %s%s%s" % (content, " " * (lenght-visible_width(content)+1), C["R"]))
+    elif align == "center":
+        pad = lenght - visible_width(content)
+        put(x-1, y, "%s%s%s%s" % (" " * (pad//2), content, C["R"], " " * (pad-pad//2)))
 
 
-def strip_acc(str):                     # Strips a string from ANSI Control Codes
-    for cc in ansi_cc():
-        str = str.replace(cc,"")
-    for uc in long_uchar():
-        str = str.replace(uc, "  ")
-    return str
+@functools.lru_cache(maxsize=4096)
+def visible_width(str):                 # Returns the number of terminal columns used to print a string
+    str = SGR.sub("", str)
+    return len(str) + len(WIDE_RE.findall(str))
 
 
-def acc_len(str):                       # Returns the size delta between a string and its ANSI Control Codes stripped counterpart
-    return len(str)-len(strip_acc(str))
+@functools.lru_cache(maxsize=4096)
+def truncate(str, width):               # Returns (str cut to width columns, its width), keeping its ANSI Control Codes
+    retv = []
+    w = 0
+    for i, part in enumerate(SGR.split(str)):
+        if i & 1:
+            retv.append(part)
+            continue
+        pw = len(part) + len(WIDE_RE.findall(part))
+        if w + pw <= width:
+            retv.append(part)
+            w += pw
+            continue
+        for ch in part:
+            cw = 2 if ch in WIDE else 1
+            if w + cw > width:
+                break
+            retv.append(ch)
+            w += cw
+        break
+    return "".join(retv), w
 
 
 def clear_content(box):                 # Clears the content of a box object
@@ -284,8 +368,7 @@ def clear_content(box):                 # Clears the content of a box object
     y1 = box["tl"]["y"] + 1
     y2 = box["br"]["y"] + 1
     for i in range (y2-y1-1):
-        cur_set(x, y1+i)
-        prn(" " * (content_w(box)+2))
+        put(x, y1+i, " " * (content_w(box)+2))
 
 
 def content_w(box):                     # Returns the available width within a box object
@@ -300,11 +383,13 @@ def clear(lines=cur_posn["exit"]["y"], s = False):      # Clears the screen
     global boxes
     if s == False:                                      # Use custom clear routine (clears all but the prompt)
         for i in range (lines):
-            cur_set(1, 1+i)
             #if boxes["console"]["tl"]["y"] != i:       # BUGS because boxes is defined in the importing program
-            prn(" ".ljust(100))
+            put(1, 1+i, " ".ljust(100))
     else:                                               # Use system clear routine
         os.system("clear")
+        with screen_lock:
+            for i in range(SCREEN_H):
+                front[i] = [BLANK] * SCREEN_W
 
 
 def dump_run_time():
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+'''
+
+Vectorized lockstep engine for KRIS VM
+Author : Benjamin Evrard - @tsunulukai 🦆 - https://adelpha.be/
+
+A KRIS machine is 256 bytes of RAM plus four 8-bit registers, so a whole
+population of machines fits in a (N, 256) and a (N, 4) uint8 array. Each
+step() executes one instruction on every running machine with masked NumPy
+operations, following the semantics of kris_cpu's instruction handlers.
+Machines stop on HLT, JNZ loops, invalid opcodes and breakpoints, and leave
+the active set:
+
+    import kris_vec
+    pop = kris_vec.Population.from_images([prog1, prog2, prog3])
+    pop.run(max_steps=10000)
+    print(pop.reason(0), pop.machine(0)["cycles"])
+
+Requires NumPy.
+
+'''
+
+__description__ = 'KRIS vectorized lockstep engine'
+__author__      = 'Benjamin Evrard'
+
+from kris_cpu import *
+import numpy as np
+
+
+# Register columns
+PC  = 0
+PTR = 1
+R1  = 2
+R2  = 3
+
+# Reason codes, indexes of REASONS
+RUNNING    = 0
+HALTED     = 1
+LOOPED     = 2
+INVALID    = 3
+BREAKPOINT = 4
+REASONS    = [None, STOP_HALT, STOP_LOOP, STOP_INVALID, STOP_BREAKPOINT]
+
+# Decoding tables, indexed by opcode byte
+NEXT  = np.array([(opcode >> 4) if not VALID[opcode] else SIZE[opcode] for opcode in range(0x100)], np.uint8)
+NEXT[OC["HLT"]] = 0                     # HLT doesn't move PC, invalid opcodes skip opcode >> 4 bytes
+STOPS = np.array([RUNNING if VALID[opcode] else INVALID for opcode in range(0x100)], np.int8)
+STOPS[OC["HLT"]] = HALTED
+
+
+class Population:                       # N KRIS machines executed in lockstep
+    def __init__(self, n, content=b""):
+        self.mem = np.zeros((n, 0x100), np.uint8)
+        self.reg = np.zeros((n, 4), np.uint8)
+        self.cycles = np.zeros(n, np.int64)
+        self.reasons = np.zeros(n, np.int8)
+        self.active = np.arange(n)      # Indexes of the running machines
+        content = bytes(content[:0x100])
+        if content:
+            self.mem[:, :len(content)] = np.frombuffer(content, np.uint8)
+
+    @classmethod
+    def from_images(cls, images):       # Returns a population booted with one program content per machine
+        pop = cls(len(images))
+        for i, content in enumerate(images):
+            pop.load(i, content)
+        return pop
+
+    def __len__(self):
+        return len(self.reg)
+
+    def load(self, i, content):         # Resets machine i with content mapped at address 0
+        content = bytes(content[:0x100])
+        self.mem[i] = 0
+        self.mem[i, :len(content)] = np.frombuffer(content, np.uint8)
+        self.reg[i] = 0
+        self.cycles[i] = 0
+        if self.reasons[i] != RUNNING:
+            self.reasons[i] = RUNNING
+            self.active = np.union1d(self.active, [i])
+
+    def step(self, breakpoints=None):   # Executes one instruction on every running machine, returns how many are still running
+        idx = self.active
+        if not len(idx):
+            return 0
+        mem = self.mem
+        reg = self.reg[idx]
+        pc, ptr, r1, r2 = reg[:, PC], reg[:, PTR], reg[:, R1], reg[:, R2]
+        op = mem[idx, pc]
+        arg = mem[idx, pc + np.uint8(1)]
+
+        is_op = lambda k: op == OC[k]
+        store = is_op("STORE")
+        jump = is_op("JNZ") & (r1 != 0)
+        new_r1 = np.select(
+            [is_op("XOR"), is_op("ADD"), is_op("LOAD"), is_op("SWAP"), is_op("SET_R1")],
+            [r1 ^ r2, r1 + r2, mem[idx, ptr], r2, arg], r1)
+        new_r2 = np.where(is_op("SWAP"), r1, r2)
+        new_ptr = np.where(is_op("SET_PTR"), r1, ptr)
+        new_pc = np.where(jump, arg, pc + NEXT[op])
+
+        if store.any():
+            mem[idx[store], ptr[store]] = r1[store]
+        self.reg[idx] = np.stack([new_pc, new_ptr, new_r1, new_r2], axis=1)
+        self.cycles[idx] += 1
+
+        stop = STOPS[op]
+        stop[jump & (arg == pc)] = LOOPED
+        if breakpoints is not None:
+            stop[(stop == RUNNING) & breakpoints[new_pc]] = BREAKPOINT
+        done = stop != RUNNING
+        if done.any():
+            self.reasons[idx[done]] = stop[done]
+            self.active = idx[~done]
+        return len(self.active)
+
+    def run(self, max_steps=None, breakpoints=()):  # Steps until every machine stopped or max_steps, returns the number of steps
+        bps = None
+        if len(breakpoints):
+            bps = np.zeros(0x100, bool)
+            bps[list(breakpoints)] = True
+        steps = 0
+        while len(self.active) and steps != max_steps:
+            self.step(bps)
+            steps += 1
+        return steps
+
+    def reason(self, i):                # Returns the STOP_* reason of machine i, None while it's running
+        return REASONS[self.reasons[i]]
+
+    def machine(self, i):               # Returns a KrisVM copy of machine i
+        vm = KrisVM()
+        vm.memory.load(self.mem[i].tobytes())
+        vm.r.update({"PC": int(self.reg[i, PC]), "PTR": int(self.reg[i, PTR]),
+                     "R1": int(self.reg[i, R1]), "R2": int(self.reg[i, R2])})
+        vm.cycles = int(self.cycles[i])
+        vm.reason = self.reason(i)
+        vm.halt = vm.reason in [STOP_HALT, STOP_LOOP]
+        return vm
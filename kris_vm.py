@@ -20,17 +20,58 @@
   ════════
     Usage:
         kris_vm.py [options] [[-a] <program>]
+        kris_vm.py --headless [--jit] [--max-steps <n>] [--break <addr>]... [-t <level>] [--profile <file>] [-a] <program>
+        kris_vm.py batch [--jobs <n>] [--max-steps <n>] [--timeout <s>] [--jit] [--loops] <path>...
+        kris_vm.py asm [-O] [-o <file>] [--listing <file>] [--symbols <file>] <source>
+        kris_vm.py disasm [--dot] [-o <file>] [-a] <program>
+        kris_vm.py analyze [-o <file>] [-a] <program>
 
     Options:
-        -l <logfile>    Log file (defaults to computer.log)
-        -d              Enable KRIS display at startup
-        -a              Program file is in KRIS asm
-        <program>       Program to load
+        -l <logfile>        Log file (defaults to computer.log)
+        --history <n>       Number of status lines kept in memory [default: 1000]
+                            (1 to 4096, the size of the trace buffer)
+        -d                  Enable KRIS display at startup
+        --animate           Loads programs one byte (or source line) per clock cycle
+        -a                  Program file is in KRIS asm
+        -t <level>          Trace level: off, summary (jumps, stores and stops) or
+                            full (defaults to full, or off when headless)
+        --headless          Runs the program without UI, then prints the final
+                            registers, cycle count and display content
+        --max-steps <n>     Stops a headless run after n instructions (batch
+                            runs default to 1000000)
+        --break <addr>      Stops a headless run when PC reaches addr (hex)
+        --profile <file>    Writes the execution profile of a headless run to a .csv
+                            (or JSON) file: per address execution, read, write and
+                            JNZ taken/not taken counts
+        --jit               Executes translated basic blocks in headless/batch mode
+        --jobs <n>          Number of batch worker processes (defaults to the
+                            number of CPUs)
+        --timeout <s>       Stops a batch program after s seconds [default: 10]
+        --loops             Stops a batch program as soon as its machine state
+                            repeats (infinite loop), reporting the loop period
+        -o <file>           Binary program written by asm (defaults to the source
+                            file name with the .kris extension), or disasm/analyze
+                            output (defaults to stdout)
+        --listing <file>    Writes the asm listing (line, address, bytes, source)
+        --symbols <file>    Writes the asm symbol table (labels and equ constants)
+        -O                  Optimizes the assembled program with kris_opt peephole
+                            rules, then prints the bytes and instructions saved
+        --dot               Outputs the disasm control-flow graph in Graphviz DOT
+        <program>           Program to load
+        <path>              Directory or glob pattern of the .kris/.krisa programs
+                            to run in batch, printed as one JSON line each
+        <source>            KRIS asm source to assemble
 
 
     Example:
         ./kris_vm.py    helloworld.kris  -l helloworld.log -d
         ./kris_vm.py -a helloworld.krisa -l helloworld.log -d
+        ./kris_vm.py --headless --max-steps 10000 helloworld.krisa
+        ./kris_vm.py batch --jobs 4 --max-steps 100000 tests/ "more/*.krisa"
+        ./kris_vm.py asm helloworld.krisa -o helloworld.kris --listing helloworld.lst
+        ./kris_vm.py asm -O helloworld.krisa -o helloworld-opt.kris
+        ./kris_vm.py disasm --dot helloworld.kris -o helloworld.dot
+        ./kris_vm.py analyze helloworld.kris
 
 
 
@@ -119,24 +160,59 @@
     ├─────────────┼──────────────────────────────────────────────────────────────────┤
     │ (s)tep      │ Executes a single instruction; it's the default command          │
     │ (r)un       │ Executes instructions until interrupted by user/breakpoint       │
+    │ (u)ndo      │ Steps back a single instruction                                  │
+    │ (U)ndo run  │ Steps back until a breakpoint or the start of the history        │
     │ (a)ddbp     │ Adds an execution breakpoint at an address of your choice        │
-    │ (d)elbp     │ Removes a breakpoint                                             │
+    │ (d)elbp     │ Removes a breakpoint, watchpoint or condition ('*' for all)      │
+    │ pr(o)file   │ Toggles profiling (Memory box heat-map), clears or exports it    │
+    │ (w)atch     │ Breaks on reads/writes of a memory range, or on a condition on   │
+    │             │ the registers (e.g. 'R1 == 0'), anywhere or at an address        │
     │ (l)og       │ Displays the last n lines of the status/trace log                │
     │ (m)an       │ Displays the current manual                                      │
     │ (q)uit      │ Exits the debugger                                               │
     │ (c)lear     │ Clears and refreshes the screen                                  │
-    │ (C)lock     │ Change the CPU clock speed                                       │
+    │ (C)lock     │ Change the CPU clock speed; 0 or 'max' runs unthrottled          │
+    │ (T)race     │ Sets the trace level (off/summary/full) of the status/trace log  │
     │ (D)isplay   │ Toggles the KRIS display (hex/ascii views)                       │
     │ (L)oad      │ Loads a program from disk                                        │
+    │ (k)eep      │ Saves/restores a named snapshot, in memory or as a *.krss file   │
     │ (P)rogram   │ Enters programming mode; allows you to edit memory content       │
     │ (A)ssemble  │ Enters assembly mode; allows you to input KRIS ASM instructions  │
     │             │ In this mode, you can use the keyword 'address_xxh:' to indicate │
     │             │ at which offset your assembly bloc begins                        │
+    │             │ and refer to the labels/constants of the loaded source           │
     │ (R)eset     │ Resets the KRIS computer                                         │
     │ (S)ave      │ Saves a program to disk until specified memory address           │
     │ (E)dit      │ Edits a Register/Memory value                                    │
     └─────────────┴──────────────────────────────────────────────────────────────────┘
 
+
+
+
+  6. Assembly language
+  ════════════════════
+
+    Sources (*.krisa) are assembled in two passes, so that instructions can
+    refer to labels defined further. A line holds an optional label, then an
+    instruction, a directive or raw bytes, then an optional '#' comment:
+
+        DISPLAY equ     0xf0                # Constant
+        loop:   SET_REG1 DISPLAY + 2        # Label, instruction and expression
+                JNZ     loop
+        str:    db      "Hello", 0          # Data bytes and strings
+                org     0xa0                # Origin, same as address_a0h:
+                0x48 0x65 0x6c              # Raw bytes
+
+    Numbers are hexadecimal, with or without 0x; names which aren't symbols
+    but are valid hexadecimal (ff, e0) are read as numbers too. Constants
+    defined before an org can be used by it.
+    Expressions combine numbers, 'c' characters, symbols and $ (address of the
+    current line) with + - * / % & | ^ ~ << >> and parentheses.
+
+    './kris_vm.py asm' writes the binary and, on request, a listing and a symbol
+    table; the Disassembly box shows the labels and operands of the loaded
+    source.
+
 '''
 
 __description__ = 'Compatible KRIS ™ ("Kleine Ridikule Inefficiente Systeem") Debugger/Emulator'
@@ -144,10 +220,19 @@ __author__      = 'Benjamin Evrard, based on KRIS ™ Computer Architecture by B
 
 
 from kris_ui import *
+from kris_cpu import *
+from kris_asm import *
+from kris_jit import *
+from collections import deque
 import docopt
+import itertools
+import json
+import kris_batch
+import kris_dis
+import kris_flow
+import kris_opt
 import os
 import pydoc
-import re
 import signal
 import sys
 import threading
@@ -199,37 +284,36 @@ CREADWRITE  = C["F"]["L"]["PUR"]
 CEDIT       = C["B"]["D"]["CYA"] + C["F"]["D"]["BLK"]
 CPC         = C["F"]["L"]["YEL"]
 COPC        = C["F"]["D"]["GRY"]
+CLABEL      = C["F"]["L"]["GRE"]
 CBP         = C["B"]["D"]["RED"]
+CHEAT       = [C["B"]["D"]["BLU"], C["B"]["D"]["PUR"], C["B"]["D"]["YEL"]]     # Execution heat-map, coldest first
 CHDRHEX     = C["R"]
 
 
-# VM Opcodes
-OC = {
-    "HLT"      : 0x0F,  # HALTS THE CPU
-    "XOR"      : 0x10,  # R1 = R1 ^ R2
-    "ADD"      : 0x11,  # R1 = R1 + R2
-    "LOAD"     : 0x12,  # R1 = *PTR
-    "STORE"    : 0x13,  # *PTR = R1
-    "SET_PTR"  : 0x14,  # PTR = R1
-    "SWAP"     : 0x15,  # R1 <-> R2
-    "SET_R1"   : 0x20,  # R1 = arg;
-    "JNZ"      : 0x21   # JMP NOT ZERO to arg
-}
-
 # VM Clock Speed
-CLK = 100
-
-# VM Registers
-r = {
-    "OPC": -1,
-    "PC" : 0,
-    "PTR": 0,
-    "R1" : 0,
-    "R2" : 0,
-}
-
-# VM Memory
-memory = b"\x00" * 0x100
+CLK = 100                       # Target frequency in Hz; 0 runs unthrottled
+FPS = 30                        # Maximum screen refresh rate while running
+ips = 0                         # Measured frequency of the last run, in instructions per second
+MAX_LAG = .25                   # Maximum delay, in seconds, caught up by running batches back to back
+ANIMATE = False                 # Loads programs one byte/source line per clock cycle, as a visual effect
+
+# VM State
+vm      = KrisVM(trace=Trace(TRACE_FULL), history=History(), loops=LoopDetector())
+program = Assembly("")          # Assembled source of the loaded program: symbols and operands
+
+r       = vm.r                  # VM Registers
+memory  = vm.memory             # VM Memory
+decoded = kris_dis.DecodeCache(memory, lambda pc, opcode, arg: disass(pc, opcode, arg))     # Disassembly box lines
+disass_pane = (None, "")        # ((OPC, PC, decoded.generation), text) of the last Disassembly box drawn
+mem_rows = [(None, "")] * 0x10  # (marks, text) of each Memory box row, dropped when its bytes get written
+display_cache = None            # Display box content, dropped when the display memory gets written
+regs_pane   = (None, "")        # (registers and their access flags, text) of the last Registers box built
+status_pane = (None, "")        # (status_seq, text) of the last Status box built
+status_seq  = 0                 # Number of status entries added so far
+bps_pane    = (None, "")        # (breakpoints, conditions and watchpoints, text) of the last Breakpoints boxes built
+drawn       = {}                # Content of each box as last put into the frame buffer, indexed by box name
+memory.on_write(DISPLAY, 0xff, lambda addr, val: display_written(addr, val))
+trace   = vm.trace              # VM Trace
 
 # VM Memory Operations State
 vm_opr = {
@@ -252,39 +336,18 @@ vm_opr = {
 view_disp_hex    = False        # Disable the view on the memory segment containing the computer display
 view_disp_ascii  = False        # Disable the computer display
 exit             = False        # Used as signal for thread termination when leaving the debugger
-halt             = False        # Used as signal to stop the CPU when the corresponding instruction is hit
 step             = True         # Used as signal to enable stepping mode
 clock_tick       = False        # Used as signal to enable redrawing of screen parts during user input
 refresh_ui_lines = False
 
 # Debugger Initialization
-status_hist = [" "]             # Log file
-breakpoints = [ -1 ] * 12       # Breakpoints
+status_hist = deque([" "], 1000)    # Last status lines, also streamed to the log file
+breakpoints = vm.breakpoints    # Breakpoints, sorted by address
 clear_clk   = 0                 # Counter used to completely refresh the screen periodically
 console     = "> "              # Default prompt
-program     = {                 # Default program
-    "name": "",
-    "content" : "",
-}
 
 
 
-def get_asm(opcode):
-    for k in OC:
-        if OC[k] == opcode:
-            return k
-    return "DB[%02x]" % opcode
-
-
-def get_ascii_print(b):
-    retv = ""
-    if b in range(0x20, 0x7f):
-        return chr(b)
-    else:
-        #return "ⁿₐ"
-        return "¿"
-
-
 def clock():
     global refresh_ui_lines
     while not exit:
@@ -294,9 +357,8 @@ def clock():
                 refresh_ui_lines = True
                 refresh_gui()
             else:
-                cur_sav()
                 refresh_clock()
-                cur_res()
+                flush_frame(keep_cursor=True)
                 time.sleep(1)
         time.sleep(.5)
 
@@ -308,62 +370,75 @@ def uinput(s=""):
     global clear_clk
     global boxes
     console = s
-    draw_box_content(dump_console(),boxes["console"])
+    draw("console", dump_console())
+    flush_frame()
     cur_posn["prompt"]["x"] = boxes["console"]["tl"]["x"] + 3 + len(s)
     cur_set(cur_posn["prompt"]["x"], cur_posn["prompt"]["y"])
     clock_tick = True
+    log.flush()
     retv = input()
     clock_tick = False
+    invalidate(cur_posn["prompt"]["y"])                 # The terminal echoed the user input on the console line
     cur_set(cur_posn["prompt"]["x"], cur_posn["prompt"]["y"])
     clear_clk += 1
     if not (clear_clk % 10):
         #clear()
         draw_ui(boxes)
+        drawn.clear()
         refresh_gui()
     return retv
 
 
-def refresh_gui(con=True):
+def draw(name, content, a="left", c=""):   # Puts the content of a box into the frame buffer, unless it is already there
+    if drawn.get(name) != content:
+        draw_box_content(content, boxes[name], a, c)
+        drawn[name] = content
+
+
+def refresh_gui(con=True, flush=True):
     global refresh_ui_lines
     if refresh_ui_lines:
         draw_ui(boxes)
+        drawn.clear()
         refresh_ui_lines = False
-    draw_box_content(title,boxes["title"], a="center", c=C["F"]["L"]["RED"])
-    draw_box_content(dump_time(icon=True),boxes["clock"], a="center")
-    draw_box_content(dump_memory(),boxes["memory"])
-    draw_box_content(dump_registers(),boxes["registers"])
-    draw_box_content(dump_disass(),boxes["disassembly"])
-    cur_set(cur_posn["PC"]["x"],cur_posn["PC"]["y"])
-    stdo_wf("%s⮞%s" % (C["F"]["L"]["RED"], C["R"]))
-    cur_set(cur_posn["PC"]["x"]+content_w(boxes["disassembly"])+1,cur_posn["PC"]["y"])
-    stdo_wf("%s⮜%s" % (C["F"]["L"]["RED"], C["R"]))
-    draw_box_content(dump_display(),boxes["display"])
-    draw_box_content(dump_clockspeed(),boxes["cpuclock"], a="center")
-    draw_box_content(dump_run_time(),boxes["losttime"], a="center")
-    draw_box_content(dump_status(),boxes["status"])
-    draw_box_content("\n".join(dump_breakpoints().split("\n")[0:3]),boxes["breakpoints1"])
-    draw_box_content("\n".join(dump_breakpoints().split("\n")[3:6]),boxes["breakpoints2"])
-    draw_box_content("\n".join(dump_breakpoints().split("\n")[6:9]),boxes["breakpoints3"])
-    draw_box_content("\n".join(dump_breakpoints().split("\n")[9:12]),boxes["breakpoints4"])
-    draw_box_content(dump_validcmd(),boxes["validcmd"])
+    draw("title", title, a="center", c=C["F"]["L"]["RED"])
+    draw("clock", dump_time(icon=True), a="center")
+    draw("memory", dump_memory())
+    draw("registers", dump_registers())
+    draw("disassembly", dump_disass())
+    put(cur_posn["PC"]["x"], cur_posn["PC"]["y"], "%s⮞%s" % (C["F"]["L"]["RED"], C["R"]))
+    put(cur_posn["PC"]["x"]+content_w(boxes["disassembly"])+1, cur_posn["PC"]["y"], "%s⮜%s" % (C["F"]["L"]["RED"], C["R"]))
+    draw("display", dump_display())
+    draw("cpuclock", dump_clockspeed(), a="center")
+    draw("losttime", dump_lost_time(), a="center")
+    draw("status", dump_status())
+    bps = dump_breakpoints().split("\n")
+    draw("breakpoints1", "\n".join(bps[0:3]))
+    draw("breakpoints2", "\n".join(bps[3:6]))
+    draw("breakpoints3", "\n".join(bps[6:9]))
+    draw("breakpoints4", "\n".join(bps[9:12]))
+    draw("validcmd", dump_validcmd())
     if con:
-        draw_box_content(dump_console(),boxes["console"])
+        draw("console", dump_console())
+    if flush:
+        flush_frame()
 
 
 def clear(lines=cur_posn["exit"]["y"], s = False):      # Clears the screen
     global boxes
     if s == False:                                      # Use custom clear routine (clears all but the console prompt line)
         for i in range (lines):
-            cur_set(1, 1+i)
             if boxes["console"]["tl"]["y"] != i:
-                prn(" ".ljust(100))
+                put(1, 1+i, " ".ljust(100))
     else:                                               # Use system clear routine
         os.system("clear")
+        invalidate()
+    drawn.clear()
 
 
 def refresh_clock():
-    draw_box_content(dump_time(icon=True),boxes["clock"], a="center")
-    draw_box_content(dump_run_time(),boxes["losttime"], a="center")
+    draw("clock", dump_time(icon=True), a="center")
+    draw("losttime", dump_lost_time(), a="center")
 
 
 def read_f_keys():
@@ -371,16 +446,100 @@ def read_f_keys():
         time.sleep(.5)
 
 
+class Pacer:                            # Paces instruction batches on a monotonic deadline
+    def __init__(self, max_lag=MAX_LAG):
+        self.max_lag = max_lag
+        self.lost = 0                   # Accumulated delay that couldn't be caught up, in seconds
+        self.deadline = 0
+
+    def start(self):
+        self.deadline = time.perf_counter()
+
+    def wait(self, n, hz):              # Sleeps until n more instructions are due at hz
+        self.deadline += n / hz
+        now = time.perf_counter()
+        if now < self.deadline:
+            time.sleep(self.deadline - now)
+        elif now - self.deadline > self.max_lag:        # Stalled for too long: give up on the excess
+            self.lost += now - self.deadline - self.max_lag
+            self.deadline = now - self.max_lag
+
+
+pacer = Pacer()
+
+
+class LogWriter:                        # Streams the status history entries to the log file
+    def __init__(self, flush_lines=512, flush_secs=1.0):
+        self.f = None
+        self.pending = []               # Entries not formatted yet
+        self.flush_lines = flush_lines  # Must stay below the trace buffer size
+        self.flush_secs = flush_secs
+        self.last_flush = time.monotonic()
+
+    def open(self, path, hist=()):      # Opens the log file, starting with the entries already in history
+        self.f = open(path, "w", buffering=1 << 16)
+        self.pending.extend(hist)
+        self.flush()
+
+    def add(self, entry):
+        if self.f is None:
+            return
+        self.pending.append(entry)
+        if len(self.pending) >= self.flush_lines or time.monotonic() - self.last_flush >= self.flush_secs:
+            self.flush()
+
+    def flush(self):
+        if self.f is None:
+            return
+        if self.pending:
+            self.f.write("".join(" %s\n" % fmt_status(e) for e in self.pending))
+            self.pending = []
+        self.f.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
+
+
+log = LogWriter()
+
+
+def status(e):                          # Appends an entry to the status history and the log file
+    global status_seq
+    status_hist.append(e)
+    status_seq += 1
+    log.add(e)
+
+
 def info(t, s=""):
-    status_hist.append("%s %s%s: %s%s" % (dump_run_time(), C["F"]["L"]["CYA"], t.ljust(8), s, C["R"]))
+    status("%s %s%s: %s%s" % (dump_run_time(), C["F"]["L"]["CYA"], t.ljust(8), s, C["R"]))
 
 
 def error(t, s=""):
-    status_hist.append("%s %s%s: %s%s" % (dump_run_time(), C["F"]["L"]["RED"], t.ljust(8), s, C["R"]))
+    status("%s %s%s: %s%s" % (dump_run_time(), C["F"]["L"]["RED"], t.ljust(8), s, C["R"]))
 
 
 def warning(t, s=""):
-    status_hist.append("%s %s%s: %s%s" % (dump_run_time(), C["F"]["L"]["YEL"], t.ljust(8), s, C["R"]))
+    status("%s %s%s: %s%s" % (dump_run_time(), C["F"]["L"]["YEL"], t.ljust(8), s, C["R"]))
+
+
+def fmt_status(e):                      # Returns the text of a status history entry
+    if type(e) is not int:
+        return e
+    t = trace.get(e)                    # Trace record number
+    if t is None:
+        return "----- %s%s: %s%s" % (C["F"]["D"]["GRY"], "TRACE".ljust(8), "Record evicted from the trace buffer", C["R"])
+    if t.opcode == OC["HLT"]:
+        c = C["F"]["L"]["YEL"]
+    elif not VALID[t.opcode]:
+        c = C["F"]["L"]["RED"]
+    else:
+        c = C["F"]["L"]["CYA"]
+    instr, s = fmt_record(t)
+    return "%05d %s%s: %s%s" % (t.seq % 100000, c, instr.ljust(8), s, C["R"])
 
 
 def dump_console():
@@ -388,26 +547,64 @@ def dump_console():
 
 
 def dump_status():
+    global status_pane
+    if status_pane[0] == status_seq:    # No entry added since the last frame
+        return status_pane[1]
     retv = ""
-    lines = reversed(status_hist)
+    lines = itertools.islice(reversed(status_hist), content_h(boxes["status"])+1)
     for line in lines:
-        retv += line[6:] + "\n"
+        retv += fmt_status(line)[6:] + "\n"
+    status_pane = (status_seq, retv)
     return retv
 
 
 def dump_memory():
     retv = CHDRHEX + "  🦆 │"
-    hexvalues = ""
     for i in range(0x10):
         retv +=" %02x" % i
         if i % 16 == 0x7:
             retv +=" "
     retv += C["R"] + "\n"
     retv += "─"*5 + "┼" + "─"*49 + "\n"
-    for i in range(len(memory)):
+    dirty = memory.dirty()
+    if dirty:                                           # Rows holding written bytes
+        for row in range(dirty[0] >> 4, (dirty[1] >> 4) + 1):
+            mem_rows[row] = (None, "")
+        memory.clean()
+    bps = breakpoints.bitmap
+    prof = vm.profile
+    hot = (max(prof.execs) or 1) if prof else 0
+    marks = (vm_opr["memory"]["r"], vm_opr["memory"]["w"], r["OPC"], r["PC"], vm_opr["memory"]["p"])
+    for row in range(0x10):
+        lo = row << 4
+        key = (tuple(m - lo if lo <= m < lo + 0x10 else -1 for m in marks), bytes(bps[lo:lo+0x10]),
+               row == 0xf and view_disp_hex)
+        if prof:
+            key += (hot.bit_length(), prof.execs[lo:lo+0x10], prof.reads[lo:lo+0x10], prof.writes[lo:lo+0x10])
+        if mem_rows[row][0] != key:
+            mem_rows[row] = (key, dump_memory_row(lo, hot))
+        retv += mem_rows[row][1]
+    return retv
+
+
+def dump_memory_row(lo, hot):           # Returns the Memory box line of the 16 bytes at lo
+    data = memory.data
+    bps = breakpoints.bitmap
+    prof = vm.profile
+    hexvalues = ""
+    for i in range(lo, lo + 0x10):
         c = ""
-        if i in breakpoints:
-            c = CBP
+        if prof:                                        # Heat-map: execution count as background, data accesses as foreground
+            if prof.execs[i]:
+                c += CHEAT[min(len(CHEAT)-1, len(CHEAT) * prof.execs[i].bit_length() // (hot.bit_length() + 1))]
+            if prof.reads[i] and prof.writes[i]:
+                c += CREADWRITE
+            elif prof.reads[i]:
+                c += CREAD
+            elif prof.writes[i]:
+                c += CWRITE
+        if bps[i]:
+            c += CBP
         if i == vm_opr["memory"]["r"]:
             c += CREAD
         if i == vm_opr["memory"]["w"]:
@@ -418,26 +615,20 @@ def dump_memory():
             c += CPC
         if i == vm_opr["memory"]["p"]:
             c += CEDIT
-        if i in range(0xf0,0x100) and not view_disp_hex:
+        if i >= DISPLAY and not view_disp_hex:
             hexvalues += " %s??%s" % (c+C["F"]["L"]["RED"], C["R"])
         else:
-            hexvalues += " %s%02x%s" % (c, memory[i], C["R"])
+            hexvalues += " %s%02x%s" % (c, data[i], C["R"])
         if i % 16 == 0x7:
             hexvalues += " "
-        if i % 16 == 0xf:
-            retv += "0x%02x │%s\n" % (i & 0xfffffff0, hexvalues)
-            hexvalues = ""
-            asciivalues = ""
-            labels = ""
-        elif i == len(memory)-1:
-            if i%16 < 7: hexvalues += " "
-            hexvalues += "   " *(15-i%16)
-            asciivalues += " " *(15-i%16)
-            retv += "0x%02x:  %s\n" % (i & 0xfffffff0, hexvalues)
-    return retv
+    return "0x%02x │%s\n" % (lo, hexvalues)
 
 
 def dump_registers():
+    global regs_pane
+    key = (tuple(r.items()), tuple(vm_opr["registers"].items()), view_disp_ascii)
+    if regs_pane[0] == key:             # No register nor access flag changed since the last frame
+        return regs_pane[1]
     retv = ""
     for reg, val in sorted(r.items()):
         if view_disp_ascii and reg not in ["PC", "PTR"]:
@@ -458,73 +649,128 @@ def dump_registers():
             else:
                 c = C["R"]
             retv += "%s%-*s: 0x%02x%s%s\n" % (c, 4, reg, val, s, C["R"])
+    regs_pane = (key, retv)
+    return retv
+
+
+def disass(pc, opcode, arg):            # Returns the instruction at pc, with its operand as written in the source
+    retv = get_asm(opcode)
+    if arg is not None:
+        ref = program.refs.get((pc+1) & 0xff)
+        if ref and ref[1] == arg:
+            retv += " %s" % ref[0]
+        elif opcode == OC["JNZ"] and arg in program.labels:
+            retv += " %s" % program.labels[arg]
+        else:
+            retv += " 0x%02x" % arg
     return retv
 
 
 def dump_disass():
-    retv = ""
+    global disass_pane
     opc = r["OPC"]
     pc = r["PC"]
+    key = (opc, pc, decoded.generation)
+    if disass_pane[0] == key:           # Nothing moved nor got written since the last frame
+        return disass_pane[1]
+    retv = ""
+    label = -1
 
     if opc == -1 :
         if cur_posn["PC"]["y"] != boxes["disassembly"]["tl"]["y"]+1:
             cur_posn["PC"]["y"] = boxes["disassembly"]["tl"]["y"]+1
             clear_content(boxes["disassembly"])
+            drawn.pop("disassembly", None)
     if opc != -1 :
         if cur_posn["PC"]["y"] != boxes["disassembly"]["tl"]["y"]+2:
             cur_posn["PC"]["y"] = boxes["disassembly"]["tl"]["y"]+2
             clear_content(boxes["disassembly"])
+            drawn.pop("disassembly", None)
         c = COPC
-        retv += "%s0x%02x: " % (c, opc)
-        retv += "%s" % get_asm(memory[opc])   # Instruction
-
-        OC = memory[opc]
-        if (OC >> 4) == 2:            # If Arg
-            retv += " 0x%02x" % memory[opc+1] # Arg
-        retv += "%s\n" %C["R"]
+        retv += "%s0x%02x: %s%s\n" % (c, opc, decoded[opc][3], C["R"])
 
     for i in range(content_h(boxes["disassembly"])+1):
         if pc in range(len(memory)):
             c = ""
             if i == 0:
                 c = CPC
-            retv += "%s0x%02x: " % (c,pc)         # PC
-            #retv += "%02x " % memory[pc]         # OPCODE
-            retv += "%s" % get_asm(memory[pc])    # Instruction
-
-            OC = memory[pc]
-            if (OC >> 4) == 2:            # If Arg
-                retv += " 0x%02x" % memory[pc+1]  # Arg
-
-            retv += "%s\n" %C["R"]
-            if memory[pc] >> 4 != 0:
-                pc += memory[pc] >> 4
-            else:
-                pc += 1
+            elif pc in program.labels and label != pc:  # Label line above the instruction
+                label = pc
+                retv += "%s%s:%s\n" % (CLABEL, program.labels[pc], C["R"])
+                continue
+            mnemonic, size, arg, text = decoded[pc]
+            retv += "%s0x%02x: %s%s\n" % (c, pc, text, C["R"])
+            pc += size
         else:
             clear_content(boxes["disassembly"])
+            drawn.pop("disassembly", None)
+    disass_pane = (key, retv)
     return retv
 
 
 def dump_display():
-    if view_disp_ascii:
-        return " " + memory[0xf0:].decode("ascii")
-    else:
+    global display_cache
+    if not view_disp_ascii:
         return "<DISABLED>"
+    if display_cache is None:
+        display_cache = " " + str(memory.view[DISPLAY:], "ascii")
+    return display_cache
+
+
+def display_written(addr, val):         # Write hook of the display memory
+    global display_cache
+    display_cache = None
+
+
+def fmt_hz(v):                          # Formats a frequency with a k/M suffix
+    for div, unit in [(1e6, "M"), (1e3, "k")]:
+        if v >= div:
+            return "%.3g%s" % (v / div, unit)
+    return "%d" % v
 
 
 def dump_clockspeed():
-    return "%s Hz" % (CLK)
+    return "%s / %s Hz" % (fmt_hz(ips), fmt_hz(CLK) if CLK else "max")
+
+
+def dump_lost_time():
+    return "%s lag %.2fs" % (dump_run_time(), pacer.lost)
+
+
+def bp_entries():                       # Returns the (description, delete function) of breakpoints, watchpoints and conditions
+    retv = []
+    for addr in breakpoints:
+        if addr in breakpoints.conds:
+            retv.append(("0x%02x if %s" % (addr, breakpoints.conds[addr][0]), lambda addr=addr: breakpoints.discard(addr)))
+        else:
+            retv.append(("0x%02x" % addr, lambda addr=addr: breakpoints.discard(addr)))
+    for wp in vm.watchpoints:
+        lo, hi, mode = wp
+        desc = "%s 0x%02x" % (mode.upper(), lo) if lo == hi else "%s 0x%02x-%02x" % (mode.upper(), lo, hi)
+        retv.append((desc, lambda wp=wp: vm.unwatch(wp)))
+    for cond in breakpoints.when:
+        retv.append(("? " + cond, lambda cond=cond: breakpoints.discard_when(cond)))
+    return retv
 
 
-def dump_breakpoints():
+def dump_breakpoints(slots=12):
+    global bps_pane
+    key = (tuple(breakpoints), tuple((addr, cond[0]) for addr, cond in breakpoints.conds.items()),
+           tuple(vm.watchpoints), tuple(breakpoints.when), slots)
+    if bps_pane[0] == key:              # No breakpoint, watchpoint nor condition changed since the last frame
+        return bps_pane[1]
     retv = ""
-    for i in range(len(breakpoints)):
+    bps = [desc for desc, fn in bp_entries()]
+    for i in range(slots):
         bpval = "Not set"
-        if breakpoints[i] != -1:
-            bpval = "0x%02x" % breakpoints[i]
+        if i == slots-1 and len(bps) > slots:
+            retv += "… %d more\n" % (len(bps) - i)
+            break
+        if i < len(bps):
+            bpval = bps[i]
         retv += "%02d. %s" % (i+1, bpval)
         retv += "\n"
+    bps_pane = (key, retv)
     return retv
 
 
@@ -534,10 +780,9 @@ def dump_validcmd():
 
 
 def update_memory(addr, val, silent=False):
-    global memory
-    memory = list(memory)
-    memory[addr] = val
-    memory = bytes(memory)
+    memory.write(addr, val)
+    vm.history.clear()                  # Can't step back across user edits
+    vm.loops.clear()
     if not silent:
         vm_opr["memory"]["w"] = addr
 
@@ -546,12 +791,8 @@ def add_breakpoint():
     ctx = "BP_ADD"
     err, addr = input_8bit(ctx, "Enter BreakPoint Address: ", "Address")
     if not err:
-        if addr not in breakpoints:
-            for i in range(len(breakpoints)):
-                if breakpoints[i] == -1:
-                    breakpoints[i] = addr
-                    info(ctx, "Added Breakpoint %d at address 0x%02x" % (i+1,addr))
-                    break
+        if breakpoints.add(addr):
+            info(ctx, "Added Breakpoint %d at address 0x%02x" % (breakpoints.index(addr)+1,addr))
         else:
             warning(ctx, "Breakpoint at address 0x%02x was already set" % addr)
 
@@ -560,24 +801,92 @@ def del_breakpoint():
     ctx = "BP_DEL"
     n = uinput("Enter BreakPoint Number:")
     if n == "*":
-        for i in range(len(breakpoints)):
-            breakpoints[i] = -1
+        breakpoints.clear()
+        vm.unwatch()
         info(ctx, "Deleted all breakpoints")
         return
     try:
         n = int(n) -1
-        if n in range(10):
-            if breakpoints[n] != -1:
-                info(ctx, "Deleted Breakpoint %d at address 0x%02x" % (n+1, breakpoints[n]))
-                breakpoints[n] = -1
-            else:
-                warning(ctx, "%d not set" % (n+1))
+        entries = bp_entries()
+        if n in range(len(entries)):
+            desc, fn = entries[n]
+            fn()
+            info(ctx, "Deleted Breakpoint %d (%s)" % (n+1, desc))
+        elif n >= 0:
+            warning(ctx, "%d not set" % (n+1))
         else:
             error(ctx, "%d out of range" % (n+1))
     except ValueError:
         error(ctx, "Invalid Input")
 
 
+def cmd_watch():
+    ctx = "WATCH"
+    mode = ""
+    while mode.lower() not in ["r", "w", "a", "c", "q"]:
+        mode = uinput("Watch (R)eads, (W)rites, (A)ll accesses, or break on a (C)ondition ?")
+    mode = mode.lower()
+    if mode == "q":
+        return
+    if mode == "c":
+        cond = uinput("Condition (e.g. R1 == 0, PTR >= 0xf0 and R2 != 1):")
+        err, addr = 0, None
+        at = uinput("At address (empty for anywhere):")
+        if at:
+            err, addr = input_8bit(ctx, "", "Address", at)
+        if err:
+            return
+        try:
+            if addr is None:
+                breakpoints.add_when(cond)
+                info(ctx, "Breaking when %s" % cond)
+            elif breakpoints.add(addr, cond):
+                info(ctx, "Added Breakpoint %d at address 0x%02x if %s" % (breakpoints.index(addr)+1, addr, cond))
+            else:
+                warning(ctx, "Breakpoint at address 0x%02x was already set" % addr)
+        except ValueError as e:
+            error(ctx, str(e))
+        return
+    rng = uinput("Address or range (e.g. a0 or f0-ff):").split("-")
+    err, lo = input_8bit(ctx, "", "Address", rng[0].strip())
+    hi = lo
+    if not err and len(rng) == 2:
+        err, hi = input_8bit(ctx, "", "Address", rng[1].strip())
+    if err:
+        return
+    if len(rng) > 2 or hi < lo:
+        error(ctx, "Invalid range '%s'" % "-".join(rng))
+        return
+    vm.watch(lo, hi, {"r": "r", "w": "w", "a": "rw"}[mode])
+    info(ctx, "Watching %s of 0x%02x-0x%02x" % ({"r": "reads", "w": "writes", "a": "accesses"}[mode], lo, hi))
+
+
+def cmd_profile():
+    ctx = "PROF"
+    mode = ""
+    while mode.lower() not in ["o", "f", "c", "e", "q"]:
+        mode = uinput("Profiling (O)n, O(f)f, (C)lear or (E)xport ?")
+    mode = mode.lower()
+    if mode == "o":
+        vm.profile = vm.profile or Profile()
+        info(ctx, "Profiling enabled; heat-map shown in the Memory box")
+    elif mode == "f":
+        vm.profile = None
+        info(ctx, "Profiling disabled")
+    elif mode == "c" and vm.profile:
+        vm.profile.clear()
+        info(ctx, "Profile cleared")
+    elif mode == "e" and vm.profile:
+        fn = uinput("Export to file (.csv or .json):")
+        try:
+            vm.profile.save(fn)
+            info(ctx, "Profile exported to '%s'" % fn)
+        except OSError:
+            error(ctx, "Can't write file '%s'" % fn)
+    elif mode != "q":
+        warning(ctx, "Profiling is disabled")
+
+
 def input_8bit(ctx, prompt, type="Value", val = False):
     if not val:
         val = uinput("%s: %s" % (ctx,prompt))
@@ -598,177 +907,215 @@ def input_8bit(ctx, prompt, type="Value", val = False):
         return 1, 0
 
 
+# Instruction annotations for the debugger
+# Each one flags the registers/memory cells accessed by an instruction the core
+# just executed at pc; b holds the value of R1 before it ran.
+
+def dbg_xor(pc, b):
+    vm_opr["registers"]["R1"] = "rw"
+    vm_opr["registers"]["R2"] = "r"
+
+
+def dbg_load(pc, b):
+    vm_opr["registers"]["R1"] = "w"
+    vm_opr["memory"]["r"] = r["PTR"]
+
+
+def dbg_store(pc, b):
+    vm_opr["registers"]["R1"] = "r"
+    vm_opr["memory"]["w"] = r["PTR"]
+
+
+def dbg_set_ptr(pc, b):
+    vm_opr["registers"]["R1"] = "r"
+    vm_opr["registers"]["PTR"] = "w"
+
+
+def dbg_swap(pc, b):
+    vm_opr["registers"]["R1"] = "swap"
+    vm_opr["registers"]["R2"] = "swap"
+
+
+def dbg_set_r1(pc, b):
+    vm_opr["registers"]["R1"] = "w"
+    vm_opr["memory"]["r"] = (pc+1) & 0xff
+
+
+def dbg_jnz(pc, b):
+    if b != 0:
+        vm_opr["registers"]["PC"] = "w"
+
+
+def dbg_none(pc, b):
+    pass
+
+
+DEBUG = [dbg_none] * 0x100
+for k, fn in [("XOR", dbg_xor), ("ADD", dbg_xor), ("LOAD", dbg_load), ("STORE", dbg_store),
+              ("SET_PTR", dbg_set_ptr), ("SWAP", dbg_swap), ("SET_R1", dbg_set_r1), ("JNZ", dbg_jnz)]:
+    DEBUG[OC[k]] = fn
+
+
 def exec():
-    global r
-    global memory
     global step
-    global halt
 
-    r["OPC"] = r["PC"]
-    opcode = memory[r["PC"]]
-    arg = memory[r["PC"]+1]
-    instr = get_asm(opcode)
+    pc = r["PC"]
+    opcode = memory[pc]
+    b = r["R1"]
 
     for i in list(vm_opr):
         for j in list(vm_opr[i]):
             vm_opr[i][j] = -1
 
-    if instr == "XOR":
-        info(instr, "R1    = 0x%02x (R1) ^ 0x%02x (R2) = 0x%02x" % (r["R1"], r["R2"], r["R1"]^r["R2"]))
-        r["R1"] ^= r["R2"]
-        vm_opr["registers"]["R1"] = "rw"
-        vm_opr["registers"]["R2"] = "r"
-
-    if instr == "ADD":
-        info(instr, "R1    = 0x%02x (R1) + 0x%02x (R2) = 0x%02x" % (r["R1"], r["R2"], r["R1"]+r["R2"]))
-        r["R1"] += r["R2"]
-        r["R1"] &= 0xff
-        vm_opr["registers"]["R1"] = "rw"
-        vm_opr["registers"]["R2"] = "r"
-
-    if instr == "LOAD":
-        r["R1"] = memory[r["PTR"]]
-        info(instr, "R1    = *0x%02x = 0x%02x" % (r["PTR"],memory[r["PTR"]]))
-
-        vm_opr["registers"]["R1"] = "w"
-        vm_opr["memory"]["r"] = r["PTR"]
-
-    if instr == "STORE":
-        info(instr, "*0x%02x = 0x%02x" % (r["PTR"],r["R1"]))
-        memory = list(memory)
-        memory[r["PTR"]] = r["R1"]
-        memory = bytes(memory)
-
-        vm_opr["registers"]["R1"] = "r"
-        vm_opr["memory"]["w"] = r["PTR"]
-
-    if instr == "SET_PTR":
-        r["PTR"] = r["R1"]
-        info(instr, "PTR   = 0x%02x" % (r["R1"]))
-        vm_opr["registers"]["R1"] = "r"
-        vm_opr["registers"]["PTR"] = "w"
-
-    if instr == "SWAP":
-        info(instr, "R1    = 0x%02x ; R2 = 0x%02x" % (r["R2"], r["R1"]))
-        t = r["R1"]
-        r["R1"] = r["R2"]
-        r["R2"] = t
-        vm_opr["registers"]["R1"] = "swap"
-        vm_opr["registers"]["R2"] = "swap"
-
-    if instr == "SET_R1":
-        r["R1"] = arg
-        info(instr, "R1    = 0x%02x (imm)" % (arg))
-        vm_opr["registers"]["R1"] = "w"
-        vm_opr["memory"]["r"] = r["PC"]+1
-
-    if instr == "HLT":
+    n = trace.n
+    reason = vm.step()
+    DEBUG[opcode](pc, b)
+    if trace.n != n:
+        status(n)                       # Trace record, formatted when displayed
+    elif reason == STOP_HALT:
+        warning(MNEMONIC[opcode], "System Halted!")
+    elif reason == STOP_INVALID:
+        error(MNEMONIC[opcode], "Invalid instruction!")
+
+    if reason == STOP_HALT:
         step = True
-        halt = True
-        warning(instr, "System Halted!")
-
-    if "DB[" in instr:
+    elif reason == STOP_LOOP:
+        warning(MNEMONIC[opcode], "Inifinite Jump loop at 0x%02x, System Halted!" % (pc))
+    elif reason == STOP_INVALID:
         step = True
-        error(instr, "Invalid instruction!")
-
-    # Set PC for next instruction
-    if instr == "JNZ" and r["R1"] != 0 :
-        ni = memory[r["PC"]+1]
-        info(instr, "PC    = 0x%02x (Jump taken)" % (ni))
-        if ni == r["PC"]:
-            warning(instr, "Inifinite Jump loop at 0x%02x, System Halted!" % (ni))
-            halt = True
-        vm_opr["registers"]["PC"] = "w"
-    elif instr == "JNZ":
-        ni = r["PC"] + (opcode >> 4)
-        info(instr, "PC    = 0x%02x (Jump NOT taken)" % (ni))
-    elif instr == "HLT":
-        ni = r["PC"]
-    else:
-        ni = r["PC"] + (opcode >> 4)
-    r["PC"] = ni
-    ni = ""
+    elif reason == STOP_WATCH:
+        step = True
+        warning("INT", "Watchpoint hit: %s of 0x%02x at address 0x%02x" % ("Write" if opcode == OC["STORE"] else "Read", r["PTR"], pc))
+    elif reason == STOP_CYCLE:
+        step = True
+        warning("INT", "Infinite loop: machine state repeats every %d cycles (from 0x%02x back to 0x%02x)" % (vm.loops.period, pc, r["PC"]))
+
+
+def stop_at():                          # Returns a STOP_* reason if a breakpoint or condition is met at PC, else None
+    if breakpoints.bitmap[r["PC"]] or breakpoints.when:
+        return breakpoints.hit(r)
+
+
+def warn_stop(reason):
+    if reason == STOP_BREAKPOINT:
+        warning("INT", "Hit Breakpoint %d at address 0x%02x" % (breakpoints.index(r["PC"]) + 1, r["PC"]))
+    elif reason == STOP_CONDITION:
+        warning("INT", "Condition met at address 0x%02x" % r["PC"])
+
+
+def run_batch(n, until):                # Executes up to n instructions (unlimited if 0), stopping at the given time
+    done = 0
+    while not step and not vm.halt and not stop_at():
+        exec()
+        done += 1
+        if done == n or (not done & 0xff and time.perf_counter() >= until):
+            break
+    return done
 
 
 def run():
+    global ips
+    brkmsg = "Running; Press CTRL+C to Interrupt..."
+    frame = 1 / FPS
     refresh_gui()
     exec()
-    while not step and not halt and r["PC"] not in breakpoints:
-        brkmsg = "Running; Press CTRL+C to Interrupt..."
-        refresh_clock()
-        refresh_gui()
-        draw_box_content("%s%s%s" % (C["F"]["L"]["YEL"], brkmsg.ljust(content_w(boxes["status"])), C["R"]), boxes["statuso"])
-        exec()
-        time.sleep(1/CLK)
-    if r["PC"] in breakpoints:
-        warning("INT", "Hit Breakpoint %d at address 0x%02x" % (breakpoints.index(r["PC"]) + 1,r["PC"]))
+    start = last = time.perf_counter()
+    count = 0
+    pacer.start()
+    while not step and not vm.halt and not stop_at():
+        n = max(1, round(CLK * frame)) if CLK else 0    # Batch sized to about one frame of execution
+        done = run_batch(n, time.perf_counter() + frame)
+        count += done
+        if CLK:
+            pacer.wait(done, CLK)
+        now = time.perf_counter()
+        if now - start >= .5:
+            ips = count / (now - start)
+            start, count = now, 0
+        if now - last >= frame:                         # The screen shows the latest state at most FPS times per second
+            last = now
+            refresh_clock()
+            refresh_gui(flush=False)
+            draw_box_content("%s%s%s" % (C["F"]["L"]["YEL"], brkmsg.ljust(content_w(boxes["status"])), C["R"]), boxes["statuso"])
+            drawn.pop("status", None)   # The overlay hides the end of the Status box
+            flush_frame()
+    if count and time.perf_counter() > start:
+        ips = count / (time.perf_counter() - start)
+    warn_stop(stop_at())
+
+
+def step_back(n=1):                     # Steps back n instructions, or to the previous breakpoint if n is None
+    ctx = "BACK"
+    for i in list(vm_opr):
+        for j in list(vm_opr[i]):
+            vm_opr[i][j] = -1
+    cycles = vm.cycles
+    if n is None:
+        warn_stop(vm.run_back())
+    else:
+        vm.step_back(n)
+    if vm.cycles == cycles:
+        warning(ctx, "No execution history to step back into")
+    else:
+        info(ctx, "Stepped back %d instruction(s) to cycle %d, PC = 0x%02x" % (cycles - vm.cycles, vm.cycles, r["PC"]))
+    vm_opr["registers"]["PC"] = "w"
 
 
 def reset():
     ctx = "STATUS"
-    global r
-    global memory
-    global vm_opr
-    global halt
     global step
 
-    memory = b"\x00" * 0x100
-
     if len(status_hist) <= 1 :
         info(ctx, "Initializing computer")
     else:
         info(ctx, "Reinitializing computer")
 
-    r = {
-        "OPC": -1,
-        "PC" : 0,
-        "PTR": 0,
-        "R1" : 0,
-        "R2" : 0,
-    }
+    pacer.lost = 0
 
-    vm_opr = {
-        "memory" : {
-            "r" : -1,
-            "w" : -1,
-            "x" : -1,
-            "p" : -1,
-        },
-        "registers" : {
-            "PC"  : -1,
-            "PTR" : -1,
-            "R1"  : -1,
-            "R2"  : -1,
-        }
-    }
+    for i in list(vm_opr):
+        for j in list(vm_opr[i]):
+            vm_opr[i][j] = -1
 
-    refresh_gui()
-    time.sleep(.5)
+    if vm.post_load:
+        vm.reset()                      # Restores the save-state taken once the program was loaded
+        info("LOAD", "Restored program '%s'" % vm.name)
+    elif not ANIMATE:
+        vm.reset()
+        if vm.image:
+            info("LOAD", "Loaded program '%s'" % vm.name)
+            vm.post_load = vm.save_state()
+    else:
+        vm.reset(reload=False)          # The program gets loaded below, one byte at a time
+        refresh_gui()
+        time.sleep(.5)
 
-    if program["content"]:
-        info("LOAD", "Loading program '%s'" % program["name"])
+        if vm.image:
+            info("LOAD", "Loading program '%s'" % vm.name)
 
-        for i in range(len(program["content"])):
-            update_memory(i, program["content"][i])
-            refresh_gui()
-            time.sleep(1/CLK)
+            for i in range(len(vm.image)):
+                update_memory(i, vm.image[i])
+                refresh_gui()
+                time.sleep(1/CLK if CLK else 0)
 
-        vm_opr["memory"]["w"] = -1
+            vm_opr["memory"]["w"] = -1
+            vm.post_load = vm.save_state()
 
-    halt = False
     step = True
 
     info(ctx, "Ready")
 
 
 def load(prog):
-    global program
     ctx = "LOAD"
+    global program
     if os.path.isfile(prog):
         try:
             f = open(prog, "rb")
-            program["name"] = prog
-            program["content"] = f.read()
+            vm.name = prog
+            vm.image = f.read()[:0x100]
+            vm.post_load = None
+            program = Assembly("")      # Binaries come without symbols
+            decoded.invalidate()
             f.close()
             return True
         except:
@@ -780,31 +1127,35 @@ def load(prog):
 
 
 def load_asm(asm):
-    global program
     ctx = "ASM"
+    global program
 
-    if os.path.isfile(asm):
-        try:
-            program["name"] = asm.replace(".kris", "", -1)
-            f = open(asm, "r")
-            info("ASM", "Loading program source code '%s'" % asm)
-            for line in f.read().split("\n"):
-                assemble(line)
-                refresh_gui()
-                time.sleep(1/CLK)
-            ptr = vm_opr["memory"]["p"]
-            vm_opr["memory"]["p"] = -1
-            info("ASM", "Source code '%s' loaded" % asm)
-            refresh_gui()
-            program["content"] = memory[:ptr]
-            f.close()
-            return True
-        except:
-            error(ctx, "Can't read file '%s'" % asm)
-            return False
-    else:
+    if not os.path.isfile(asm):
         error(ctx, "File '%s' not found" % asm)
         return False
+    try:
+        with open(asm, "r") as f:
+            prog = Assembly(f.read())
+    except (OSError, UnicodeDecodeError):
+        error(ctx, "Can't read file '%s'" % asm)
+        return False
+    info(ctx, "Loading program source code '%s'" % asm)
+    for n, text in prog.errors:
+        error(ctx, "Line %d: %s" % (n, text))
+    if ANIMATE:                         # Writes the assembled bytes one source line per clock cycle
+        for n, p, data, line in prog.rows:
+            if data:
+                for i, val in enumerate(data):
+                    update_memory(p + i, val)
+                info(ctx, "*0x%02x: %s" % (p, line.strip()))
+                refresh_gui()
+                time.sleep(1/CLK if CLK else 0)
+    vm.load(bytes(prog.image[:prog.end]))
+    vm.name = asm.replace(".kris", "", -1)
+    program = prog
+    decoded.invalidate()
+    info(ctx, "Source code '%s' assembled: %d bytes, %d symbols" % (asm, prog.end, len(prog.symbols)))
+    return True
 
 
 def cmd_display_toggle():
@@ -841,14 +1192,45 @@ def cmd_log():
         n = ""
         info(ctx, "Displaying complete status lines log")
     if n == "":
-        pydoc.ttypager("\n ".join(status_hist))
+        pydoc.ttypager("\n ".join(map(fmt_status, status_hist)))
     else:
-        pydoc.ttypager("\n ".join(status_hist[-n:]))
+        pydoc.ttypager("\n ".join(map(fmt_status, list(status_hist)[-n:])))
     input("\n\nEnd of log file; Press <ENTER> to continue")
     clear(s=True)
     refresh_ui_lines = True
 
 
+def cmd_snapshot():
+    ctx = "SNAP"
+    mode = ""
+    while mode.lower() not in ["s", "r", "q"]:
+        mode = uinput("(S)ave or (R)estore a snapshot ?")
+    if mode.lower() == "q":
+        return
+    name = uinput("Snapshot name (or *.krss file):")
+    if not name:
+        error(ctx, "Invalid name")
+    elif mode.lower() == "s":
+        try:
+            vm.save(name)
+            info(ctx, "Snapshot '%s' saved at cycle %d" % (name, vm.cycles))
+        except OSError:
+            error(ctx, "Can't write file '%s'" % name)
+    else:
+        try:
+            vm.restore(name)
+            for i in list(vm_opr):
+                for j in list(vm_opr[i]):
+                    vm_opr[i][j] = -1
+            info(ctx, "Snapshot '%s' restored at cycle %d" % (name, vm.cycles))
+        except KeyError:
+            error(ctx, "No snapshot named '%s'" % name)
+        except OSError:
+            error(ctx, "Can't read file '%s'" % name)
+        except ValueError:
+            error(ctx, "Invalid snapshot file '%s'" % name)
+
+
 def cmd_load():
     ctx = "LOAD"
     format = ""
@@ -860,7 +1242,8 @@ def cmd_load():
             reset()
     elif format.lower() == "s":
         if os.path.isfile(prog):
-            program["content"] = False
+            vm.image = b""
+            vm.post_load = None
             reset()
             load_asm(prog)
         else:
@@ -877,7 +1260,7 @@ def cmd_save():
         f = ""
         try:
             f = open(fn, "xb")
-            f.write(memory[:addr+1])
+            f.write(memory.view[:addr+1])
             info(ctx, "Program saved to file as '%s' (Memory 0x00-0x%02x)" % (fn,addr))
         except FileExistsError:
             error(ctx, "File already exists")
@@ -895,6 +1278,8 @@ def cmd_edit():
         err, val = input_8bit(ctx, "New value for register %s:" % reg)
         if not err:
             r[reg] = val
+            vm.history.clear()
+            vm.loops.clear()
             info(ctx, "%s = 0x%02x" % (reg, val))
     elif reg == "M":
         err, addr = input_8bit(ctx, "Which memory address do you want to update ?", "Address")
@@ -955,76 +1340,49 @@ def cmd_assemble():
 
 
 def assemble(cmd):
-    cmd = cmd.lstrip().rstrip().replace("SET_REG1", "SET_R1")
-    if cmd:
-        ctx = "ASM"
-        match = False
-        infostr =  "*0x%02x: " % vm_opr["memory"]["p"]
-        for opcode in OC.keys():
-            if cmd.startswith(opcode):
-                match = True
-                if OC[opcode] >> 4 == 2:
-                    if (vm_opr["memory"]["p"]+1) == (vm_opr["memory"]["p"]+1) & 0xff:
-                        arg = cmd.replace(opcode, "").lstrip()
-                        try:
-                            argval = int(arg,16)
-                            if argval == argval & 0xff:
-                                infostr += "%-15s=> '0x%02x%02x'"  % (("'" + opcode + " " + arg + "'"),OC[opcode], argval)
-                                info(ctx,  infostr)
-                                update_memory(vm_opr["memory"]["p"], OC[opcode])
-                                update_memory(vm_opr["memory"]["p"]+1, argval)
-                                vm_opr["memory"]["p"] +=2
-                            else:
-                                error(ctx,"%s argument '0x%02x' out of range" % (opcode, argval))
-                        except:
-                            error(ctx, "Invalid argument provided for '%s' instruction" % opcode)
-                    else:
-                        error(ctx, "Not enough memory space available for a 2 bytes instruction")
-                else:
-                    infostr += "%-15s=> '0x%02x'"  % ("'"+opcode+"'",OC[opcode])
-                    info(ctx,  infostr)
-                    update_memory(vm_opr["memory"]["p"], OC[opcode])
-                    vm_opr["memory"]["p"] +=1
-        if cmd.startswith("address_") and cmd.endswith("h:"):
-            match = True
-            #address = int(cmd.replace("address_","").replace("h:", ""),16)
-            err, addr = input_8bit(ctx, "", type="Address", val = cmd.replace("address_","").replace("h:", ""))
-            if not err:
-                info(ctx, "Address 0x%02x" % addr)
-                vm_opr["memory"]["p"] = addr
-        if cmd.startswith("#"):
-            match = True
-            info(ctx+"-C", "%s" % cmd)
-        if not match:
-            try:
-                regmatch = re.findall("0x[0-9a-f]{1,2}", cmd)
-                for m in regmatch:
-                    cmd = int(m,16)
-                    if cmd == cmd & 0xff:
-                        infostr = "*0x%02x: 'DB[0x%02x]'     => '0x%02x'" % (vm_opr["memory"]["p"], cmd, cmd)
-                        info(ctx,  infostr)
-                        update_memory(vm_opr["memory"]["p"], cmd)
-                        vm_opr["memory"]["p"] +=1
-                        match = True
-                else:
-                    raise ValueError
-            except:
-                pass
-        if not match:
-                if cmd.lower() in ["h", "m", "help", "man", "?"] :
-                    pydoc.pager(__doc__)
-                elif cmd != "q":
-                    error(ctx, "'%s' Invalid Instruction" % cmd)
+    ctx = "ASM"
+    kind, p, data, text = asm_line(cmd, vm_opr["memory"]["p"], program.symbols)
+    for addr, val in data:
+        update_memory(addr, val)
+    vm_opr["memory"]["p"] = p
+    if kind in ["code", "data", "addr", "symbol"]:
+        for line in text.split("\n"):
+            info(ctx, line)
+    elif kind == "comment":
+        info(ctx+"-C", "%s" % text)
+    elif kind == "error":
+        error(ctx, text)
+    elif kind == "unknown":
+        if cmd.strip().lower() in HELP_CMDS:
+            pydoc.pager(__doc__)
+        elif cmd.strip() != "q":
+            error(ctx, text)
+
+
+def cmd_trace(level=None):
+    ctx = "TRACE"
+    if level is None:
+        level = uinput("Trace level (off/summary/full) ?")
+    if level.lower() in TRACE_LEVELS:
+        trace.level = TRACE_LEVELS[level.lower()]
+        info(ctx, "Trace level set to '%s'" % level.lower())
+    else:
+        error(ctx, "Invalid trace level '%s'" % level)
 
 
 def cmd_clock():
     global CLK
     ctx = "CLK"
     try:
-        CLK = float(uinput("Enter the new clock speed:"))
-        if CLK == int(CLK):
-            CLK = int(CLK)
-        info(ctx, "Clock speed adjusted to %4.2f Hz" % CLK)
+        val = uinput("Enter the new clock speed (0 or 'max' for unthrottled):").strip().lower()
+        val = 0 if val == "max" else float(val)
+        if val < 0:
+            raise ValueError
+        CLK = int(val) if val == int(val) else val
+        if CLK:
+            info(ctx, "Clock speed adjusted to %4.2f Hz" % CLK)
+        else:
+            info(ctx, "Clock speed unthrottled")
     except:
         error(ctx, "Invalid value")
 
@@ -1032,12 +1390,11 @@ def cmd_clock():
 def cmd_quit(logfile):
     ctx = "STATUS"
     exit=True
-    info(ctx, "Writing debugger's log to '%s'" % logfile)
+    info(ctx, "Closing debugger's log '%s'" % logfile)
     info(ctx, "Exiting debugger")
     try:
-        f = open(logfile, "w").write("\n ".join(status_hist))
-        f.close()
-    except:
+        log.close()
+    except OSError:
         pass
     refresh_gui()
     cur_set(cur_posn["exit"]["x"],cur_posn["exit"]["y"])
@@ -1063,15 +1420,162 @@ signal.signal(signal.SIGTSTP, handler_SIGTSTP)
 signal.signal(signal.SIGQUIT, handler_SIGQUIT)
 
 
+def main_headless(args):
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    asm = True if args["-a"] else None
+    try:
+        max_steps = int(args["--max-steps"]) if args["--max-steps"] else None
+        if max_steps is not None and max_steps < 0:
+            raise ValueError("Invalid step budget '%s'" % args["--max-steps"])
+        bps = [int(addr, 16) for addr in args["--break"]]
+        if args["-t"] and args["-t"].lower() not in TRACE_LEVELS:
+            raise ValueError("Invalid trace level '%s'" % args["-t"])
+        level = TRACE_LEVELS[args["-t"].lower()] if args["-t"] else TRACE_OFF
+        m = KrisVM(trace=Trace(level) if level else None, engine=jit_run if args["--jit"] else cpu_run,
+                   profile=Profile() if args["--profile"] else None)
+        m.load(args["<program>"], asm)
+        m.breakpoints.update(bps)
+    except (OSError, ValueError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        sys.exit(1)
+    m.run(max_steps)
+    if args["--profile"]:
+        try:
+            m.profile.save(args["--profile"])
+        except OSError as e:
+            sys.stderr.write("Error: %s\n" % e)
+            sys.exit(1)
+    sys.stdout.write(dump_machine(m))
+    if level:
+        sys.stdout.write("Trace   : last %d records\n" % len(m["trace"]))
+        for t in m["trace"].records():
+            sys.stdout.write("  %5d  0x%02x  %-8s: %s\n" % ((t.seq, t.pc) + fmt_record(t)))
+    sys.exit(0)
+
+
+def main_asm(args):
+    src = args["<source>"]
+    out = args["-o"] or os.path.splitext(src)[0] + ".kris"
+    opt = None
+    try:
+        with open(src, "r") as f:
+            source = f.read()
+    except (OSError, UnicodeDecodeError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        sys.exit(1)
+    if args["-O"]:
+        opt = kris_opt.Optimization(source)
+        prog = opt.after
+    else:
+        prog = Assembly(source)
+    for n, text in prog.errors:
+        sys.stderr.write("%s:%d: %s\n" % (src, n, text))
+    if prog.errors:
+        sys.exit(1)
+    try:
+        with open(out, "wb") as f:
+            f.write(prog.image[:prog.end])
+        if args["--listing"]:
+            with open(args["--listing"], "w") as f:
+                f.write(prog.listing())
+        if args["--symbols"]:
+            with open(args["--symbols"], "w") as f:
+                f.write(prog.symbol_table())
+    except OSError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        sys.exit(1)
+    sys.stdout.write("%s: %d bytes\n" % (out, prog.end))
+    if opt:
+        sys.stdout.write(opt.report())
+    sys.exit(0)
+
+
+def read_program(prog, asm=False):      # Returns the content of a program and its labels (None for a binary)
+    if asm or prog.endswith(".krisa"):
+        with open(prog, "r") as f:
+            src = Assembly(f.read())
+        for n, text in src.errors:      # Same report as "asm", rather than working on a partly assembled image
+            sys.stderr.write("%s:%d: %s\n" % (prog, n, text))
+        if src.errors:
+            sys.exit(1)
+        return src.image[:src.end], src.labels
+    with open(prog, "rb") as f:
+        return f.read(), None
+
+
+def main_disasm(args):
+    try:
+        content, names = read_program(args["<program>"], args["-a"])
+        dis = kris_dis.Disassembly(content, names=names)
+        text = dis.dot() if args["--dot"] else dis.text()
+        if args["-o"]:
+            with open(args["-o"], "w") as f:
+                f.write(text)
+        else:
+            sys.stdout.write(text)
+    except (OSError, UnicodeDecodeError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        sys.exit(1)
+    sys.exit(0)
+
+
+def main_analyze(args):
+    try:
+        content, names = read_program(args["<program>"], args["-a"])
+        text = kris_flow.Analysis(content, names=names).report()
+        if args["-o"]:
+            with open(args["-o"], "w") as f:
+                f.write(text)
+        else:
+            sys.stdout.write(text)
+    except (OSError, UnicodeDecodeError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        sys.exit(1)
+    sys.exit(0)
+
+
+def main_batch(args):
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    try:
+        jobs = int(args["--jobs"]) if args["--jobs"] else None
+        if jobs is not None and jobs < 1:
+            raise ValueError("Invalid number of jobs '%s'" % args["--jobs"])
+        max_steps = int(args["--max-steps"]) if args["--max-steps"] else kris_batch.MAX_STEPS
+        timeout = float(args["--timeout"])
+    except ValueError as e:
+        sys.stderr.write("Error: %s\n" % e)
+        sys.exit(1)
+    for res in kris_batch.batch(args["<path>"], jobs, max_steps, timeout, args["--jit"], args["--loops"]):
+        sys.stdout.write(json.dumps(res) + "\n")
+        sys.stdout.flush()
+    sys.exit(0)
+
+
 def main():
     global step
-    global halt
+    global ANIMATE
+    global status_hist
     global view_disp_ascii
     global view_disp_hex
 
     # Read command line arguments
     args = docopt.docopt(__doc__)
 
+    if args["--headless"]:
+        main_headless(args)
+
+    if args["batch"]:
+        main_batch(args)
+
+    if args["asm"]:
+        main_asm(args)
+
+    if args["disasm"]:
+        main_disasm(args)
+
+    if args["analyze"]:
+        main_analyze(args)
+
 
     if args["<program>"] and os.path.isfile(args["<program>"]) and not args["-a"]:
         load(args["<program>"])
@@ -1084,6 +1588,25 @@ def main():
     if not logfile.endswith(".log"):
         logfile += ".log"
 
+    try:
+        n = int(args["--history"])
+    except ValueError:
+        n = 0
+    if not 0 < n <= trace.size:         # Instruction entries refer to trace records, which must outlive them
+        sys.stderr.write("Error: --history must be between 1 and %d\n" % trace.size)
+        sys.exit(1)
+    status_hist = deque(status_hist, n)
+    try:
+        log.open(logfile, status_hist)
+    except OSError:
+        error("STATUS", "Can't open log file '%s'" % logfile)
+
+    if args["-t"]:
+        cmd_trace(args["-t"])
+
+    if args["--animate"]:
+        ANIMATE = True
+
     if args["-d"]:
         view_disp_hex = True
         view_disp_ascii = True
@@ -1092,6 +1615,7 @@ def main():
     # Init GUI
     clear(s=True)
     draw_ui(boxes)
+    drawn.clear()
     refresh_gui()
     reset()
     fcmd = ""
@@ -1130,9 +1654,16 @@ def main():
             ctx = "STATUS"
             info(ctx, "Running; press CTRL+C to interrupt")
             step = False
-            halt = False
+            vm.halt = False
             run()
 
+        elif cmd == "u" or cmd.lower() in ["back", "rstep"]:
+            step_back()
+
+        elif cmd == "U" or cmd.lower() in ["rrun", "rcont"]:
+            info("STATUS", "Running backwards to the previous breakpoint")
+            step_back(None)
+
         elif cmd == "A":
             cmd_assemble()
 
@@ -1142,16 +1673,26 @@ def main():
         elif cmd == "d" or cmd.lower() in ["delbp"]:
             del_breakpoint()
 
+        elif cmd == "w" or cmd.lower() in ["watch", "cond"]:
+            cmd_watch()
+
+        elif cmd == "o" or cmd.lower() in ["prof", "profile"]:
+            cmd_profile()
+
         elif cmd == "D" or cmd.lower() == "display":
             cmd_display_toggle()
 
         elif cmd == "C" or cmd.lower() in ["clk", "clock"]:
             cmd_clock()
 
+        elif cmd == "T" or cmd.lower() == "trace":
+            cmd_trace()
+
         elif cmd == "c" or cmd.lower() in ["clr", "clear"]:
             info("CLEAR", "Refreshing Screen")
             clear(s=True)
             draw_ui(boxes)
+            drawn.clear()
             refresh_gui()
 
         elif cmd == "l" or cmd.lower() in ["log","status"]:
@@ -1160,6 +1701,9 @@ def main():
         elif cmd == "L" or cmd.lower() == "load":
             cmd_load()
 
+        elif cmd == "k" or cmd.lower() in ["keep", "snap", "snapshot"]:
+            cmd_snapshot()
+
         elif cmd == "S" or cmd.lower() == "save":
             cmd_save()
 
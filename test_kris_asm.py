@@ -0,0 +1,20 @@
+from kris_asm import *
+
+
+def test_org_uses_constants():
+    prog = Assembly("BASE equ 0xa0\n    SET_R1 1\n    org BASE\n    db 1, 2")
+    assert prog.errors == []
+    assert prog.image[0xa0:0xa2] == b"\x01\x02"
+
+
+def test_bare_hex_operands():
+    prog = Assembly("    SET_R1 ff\n    SET_PTR\n    SET_R1 e0 + 1")
+    assert prog.errors == []
+    assert prog.image[:5] == bytes([OC["SET_R1"], 0xff, OC["SET_PTR"], OC["SET_R1"], 0xe1])
+    assert asm_line("SET_R1 ff", 0)[2] == [(0, OC["SET_R1"]), (1, 0xff)]
+
+
+def test_symbols_shadow_hex_names():
+    prog = Assembly("    SET_R1 beef\n    SET_R1 fd\nbeef equ 3\nfd: HLT")
+    assert prog.errors == []
+    assert prog.image[:5] == bytes([OC["SET_R1"], 3, OC["SET_R1"], 4, OC["HLT"]])
@@ -0,0 +1,19 @@
+import os
+from kris_cpu import *
+
+HELLO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "helloworld.krisa")
+
+
+def test_restore_keeps_breakpoint_conditions():
+    vm = KrisVM()
+    vm.load(HELLO)
+    vm.breakpoints.add(0x0c, "R1 == 5")
+    vm.breakpoints.add(0x18)
+    vm.breakpoints.add_when("PTR == 0xfe")
+    vm.save("a")
+    vm.breakpoints.discard(0x18)
+    vm.restore("a")
+    assert list(vm.breakpoints) == [0x0c, 0x18]
+    assert vm.breakpoints.conds[0x0c][0] == "R1 == 5"
+    assert vm.breakpoints.when == ["PTR == 0xfe"]
+    assert vm.run(10000) == STOP_BREAKPOINT and vm.r["PC"] == 0x18   # 0x0c is never reached with R1 == 5
@@ -0,0 +1,17 @@
+import os
+from kris_cpu import *
+import kris_opt
+
+HELLO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "helloworld.krisa")
+
+
+def test_helloworld_gets_shorter():
+    with open(HELLO) as f:
+        opt = kris_opt.Optimization(f.read())
+    assert opt.skipped is None
+    assert opt.saved > 0 and opt.after.end == opt.before.end - opt.saved
+    old = KrisVM(opt.before.image[:opt.before.end])
+    new = KrisVM(opt.after.image[:opt.after.end])
+    assert old.run(10000) == new.run(10000) == STOP_LOOP
+    assert display_text(old) == display_text(new) == "Hello World !¿¿¿"
+    assert (old.r["R1"], old.r["R2"]) == (new.r["R1"], new.r["R2"])